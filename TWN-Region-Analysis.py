@@ -1,35 +1,261 @@
 import os
-import sys
+import time
+import logging
 import argparse
-import subprocess
+import itertools
+import traceback
 from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+from TWN_Pattern import pattern_identification, pattern_sweep, sweep_name, ring_identification
+from TWN_Region import region_extractor
+from TWN_Results import results_writer
+from TWN_Profile import stage, cprofile_start, cprofile_dump, profile_writer
+
+logger = logging.getLogger(__name__)
+
+
+# log one protein (or the proteins of one group) to their own files while the pipeline runs
+@contextmanager
+def protein_log(log_files, quiet):
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    handlers = [logging.FileHandler(log_file) for log_file in log_files] + ([] if quiet else [logging.StreamHandler()])
+    for handler in handlers:
+        handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+        root.addHandler(handler)
+    try:
+        yield
+    finally:
+        for handler in handlers:
+            root.removeHandler(handler)
+            handler.close()
+
+
+# patterns and regions of every threshold combination, from one neighbor search; returns the number of output sets
+def protein_sweep(trj, bd, twn, out, region, settings, centroid_radii, workers=1, cache=None, database=None, prefetch=None):
+    sweep = pattern_sweep(trj, bd, twn, settings, out / 'sweep', workers, cache, prefetch=prefetch)
+    logger.info(f"Start Region identification...")
+    with stage('region_extractor'):
+        for setting, patterns in sweep.items():
+            for centroid_radius in centroid_radii:
+                sweep_region = region / 'sweep' / f'{sweep_name(*setting)}_centroid{centroid_radius:g}'
+                os.makedirs(sweep_region, exist_ok=True)
+                for old_region in sweep_region.glob('TWN_Region_*.sdf'):
+                    os.remove(old_region)
+                regions = region_extractor(patterns, sweep_region, centroid_radius)
+                logger.info(f"{len(regions)} Regions are extracted for {sweep_region.name}.")
+                if database is not None:
+                    results_writer(database, twn.name, patterns, regions, sweep_region.name)
+    logger.info(f"Region identification complete.")
+    return len(sweep) * len(centroid_radii)
+
+
+# default thresholds : match radius, uniqueness radius, frequency cutoff and centroid radius
+thresholds = {'match_radius': [1.0], 'unique_radius': [1.0], 'min_frequency': [2], 'centroid_radius': [1.0]}
+
+
+# pattern identification then region extraction for one protein, patterns stay in memory
+# several values of a threshold make a sweep : one output set per combination under sweep/
+# pattern and region records go to the results store when database is given, stride > 0 runs the progressive mode
+def protein_pipeline(path, protein, workers, quiet, profile=False, cprofile=False, incremental=False, block=0, params=None,
+                     database=None, stride=0, top=0, prefetch=None):
+    start = time.time()
+    code = protein.split("_")[1]
+    trj = Path(path) / 'trajectory' / code / 'a_input'
+    bd = Path(path) / 'boundary' / code / 'Center.bd'
+    twn = Path(path) / 'TWN' / protein
+    out = Path(path) / 'TWN-Pattern' / protein
+    log = Path(path) / 'logs' / protein
+    region = Path(path) / 'TWN-Region' / protein
+    cache = Path(path) / 'cache' / f'{code}.npz'
+    params = dict(thresholds, **(params or {}))
+    settings = list(itertools.product(params['match_radius'], params['unique_radius'], params['min_frequency']))
+    os.makedirs(out, exist_ok=incremental)
+    os.makedirs(log, exist_ok=incremental)
+    status = 'done'
+    with protein_log([log / 'TWN-Region-Analysis.log'], quiet):
+        logger.info(f"Analysis for {protein}")
+        profiler = cprofile_start(cprofile)
+        try:
+            if len(settings) * len(params['centroid_radius']) > 1:
+                status = 'sweep failed'
+                sweep_count = protein_sweep(trj, bd, twn, out, region, settings, params['centroid_radius'], workers, cache, database,
+                                            prefetch)
+                status = f'done (sweep of {sweep_count})'
+            else:
+                status = 'pattern failed'
+                patterns = pattern_identification(trj, bd, twn, out / 'TWN.sdf', workers, cache,
+                                                  table_file=out / 'TWN_occupancy.json' if incremental else None,
+                                                  block=block, radius=settings[0][0], unique_radius=settings[0][1],
+                                                  min_frequency=settings[0][2], stride=stride, top=top, prefetch=prefetch)
+                pattern_time = time.time() - start
+
+                # Region identification
+                status = 'region failed'
+                logger.info(f"Start Region identification...")
+                os.makedirs(region, exist_ok=incremental)
+                for old_region in region.glob('TWN_Region_*.sdf'):
+                    os.remove(old_region)
+                with stage('region_extractor'):
+                    regions = region_extractor(patterns, region, params['centroid_radius'][0])
+                logger.info(f"Region identification complete.")
+                logger.info(f"{len(regions)} Regions are extracted from {protein}.")
+                if database is not None:
+                    status = 'results failed'
+                    results_writer(database, protein, patterns, regions)
+                status = f'done (pattern {pattern_time:.1f} s)'
+        except Exception:
+            logger.error(traceback.format_exc())
+        cprofile_dump(profiler, log / 'TWN-Region-Analysis.prof')
+        if profile:
+            logger.info(f'Saved profile : {profile_writer(log, "TWN-Region-Analysis")}')
+    return protein, status, time.time() - start
+
+
+# pattern identification then region extraction for every ring type (TWN set) of one PDB code, the frames are read once
+def group_pipeline(path, code, proteins, workers, quiet, profile=False, cprofile=False, incremental=False, params=None, database=None,
+                   prefetch=None):
+    start = time.time()
+    trj = Path(path) / 'trajectory' / code / 'a_input'
+    bd = Path(path) / 'boundary' / code / 'Center.bd'
+    twns = [Path(path) / 'TWN' / protein for protein in proteins]
+    outs = [Path(path) / 'TWN-Pattern' / protein for protein in proteins]
+    logs = [Path(path) / 'logs' / protein for protein in proteins]
+    regions = [Path(path) / 'TWN-Region' / protein for protein in proteins]
+    cache = Path(path) / 'cache' / f'{code}.npz'
+    params = dict(thresholds, **(params or {}))
+    for out, log in zip(outs, logs):
+        os.makedirs(out, exist_ok=incremental)
+        os.makedirs(log, exist_ok=incremental)
+    status = {protein: 'pattern failed' for protein in proteins}
+    with protein_log([log / 'TWN-Region-Analysis.log' for log in logs], quiet):
+        logger.info(f"Analysis for {code} : {', '.join(proteins)}")
+        profiler = cprofile_start(cprofile)
+        try:
+            ring_patterns = ring_identification(trj, bd, twns, [out / 'TWN.sdf' for out in outs], workers, cache,
+                                                table_files=[out / 'TWN_occupancy.json' for out in outs] if incremental else None,
+                                                radius=params['match_radius'][0], unique_radius=params['unique_radius'][0],
+                                                min_frequency=params['min_frequency'][0], prefetch=prefetch)
+            pattern_time = time.time() - start
+
+            # Region identification
+            logger.info(f"Start Region identification...")
+            for protein, region, patterns in zip(proteins, regions, ring_patterns):
+                status[protein] = 'region failed'
+                os.makedirs(region, exist_ok=incremental)
+                for old_region in region.glob('TWN_Region_*.sdf'):
+                    os.remove(old_region)
+                with stage(f'region_extractor {protein}'):
+                    extracted = region_extractor(patterns, region, params['centroid_radius'][0])
+                logger.info(f"{len(extracted)} Regions are extracted from {protein}.")
+                if database is not None:
+                    status[protein] = 'results failed'
+                    results_writer(database, protein, patterns, extracted)
+                status[protein] = f'done (group pattern {pattern_time:.1f} s)'
+            logger.info(f"Region identification complete.")
+        except Exception:
+            logger.error(traceback.format_exc())
+        for log in logs:
+            cprofile_dump(profiler, log / 'TWN-Region-Analysis.prof')
+        if profile:
+            for idx, log in enumerate(logs):
+                logger.info(f'Saved profile : {profile_writer(log, "TWN-Region-Analysis", reset=idx == len(logs) - 1)}')
+    wall_time = time.time() - start
+    return [(protein, status[protein], wall_time) for protein in proteins]
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Automatic calculation')
     parser.add_argument('-d', '--directory', required=True, help='Set your directory to analyze')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Set your number of proteins analyzed at the same time')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Set your number of parsing processes per protein')
+    parser.add_argument('-c', '--cpus', type=int, default=os.cpu_count(), help='Set your CPU budget for all jobs')
+    parser.add_argument('-pf', '--profile', action='store_true', help='Write per-stage profile reports next to the logs')
+    parser.add_argument('-cp', '--cprofile', action='store_true', help='Dump cProfile statistics next to the logs')
+    parser.add_argument('-i', '--incremental', action='store_true', help='Reuse a previous run and match only new frames and TWN files')
+    parser.add_argument('-b', '--block', type=int, default=0, help='Set your number of frames read at once per protein (0 reads the whole trajectory)')
+    parser.add_argument('-mr', '--match_radius', type=float, nargs='+', default=thresholds['match_radius'], help='Set your radius (A) matching a TWN water to a frame water')
+    parser.add_argument('-ur', '--unique_radius', type=float, nargs='+', default=thresholds['unique_radius'], help='Set your radius (A) making a TWN a duplicate of an accepted pattern')
+    parser.add_argument('-mf', '--min_frequency', type=int, nargs='+', default=thresholds['min_frequency'], help='Set your lowest frequency of a TWN pattern')
+    parser.add_argument('-cr', '--centroid_radius', type=float, nargs='+', default=thresholds['centroid_radius'], help='Set your radius (A) grouping pattern centroids into a region')
+    parser.add_argument('-db', '--database', default=None, help='Set your results store (.sqlite) filled with the patterns and regions of every protein')
+    parser.add_argument('-ps', '--progressive', type=int, default=0, help='Set your sampling stride : match every n-th frame first, then the top TWNs on every frame (0 matches every frame at once)')
+    parser.add_argument('-tp', '--top', type=int, default=0, help='Set your number of top patterns reported in progressive mode (needed with -ps)')
+    parser.add_argument('-pq', '--prefetch_depth', type=int, default=8, help='Set your number of files read ahead of the parser with -w 1 (0 reads each file when it is parsed)')
+    parser.add_argument('-rs', '--read_size', type=int, default=1024, help='Set your read size (KB) of prefetched files')
+    parser.add_argument('-g', '--group', action='store_true', help='Run the TWN sets (ring types) of one PDB code together, reading its frames once')
     args = parser.parse_args()
+    if args.block < 0:
+        parser.error('-b/--block must be 0 or a positive number of frames')
+    if args.prefetch_depth < 0:
+        parser.error('-pq/--prefetch_depth must be 0 or a positive number of files')
+    if args.read_size < 1:
+        parser.error('-rs/--read_size must be 1 KB or more')
+    for name, flag in [('match_radius', '-mr'), ('unique_radius', '-ur'), ('centroid_radius', '-cr')]:
+        if any(value <= 0 for value in getattr(args, name)):
+            parser.error(f'{flag}/--{name} must be positive')
+    if any(value < 1 for value in args.min_frequency):
+        parser.error('-mf/--min_frequency must be 1 or more')
+    if args.top and not args.progressive:
+        parser.error('-tp/--top is only used with -ps/--progressive')
+    if args.top < 0:
+        parser.error('-tp/--top must be 0 or a positive number of patterns')
+    if args.progressive and args.top < 1:
+        parser.error('-ps/--progressive needs -tp/--top, the number of top patterns to report')
+    if args.block and args.incremental:
+        parser.error('-b/--block and -i/--incremental cannot be used together')
+    params = {name: getattr(args, name) for name in thresholds}
+    if any(len(values) > 1 for values in params.values()) and (args.block or args.incremental):
+        parser.error('a sweep (several threshold values) cannot be used with -b/--block or -i/--incremental')
+    if args.group and (args.block or any(len(values) > 1 for values in params.values())):
+        parser.error('-g/--group cannot be used with -b/--block or a sweep (several threshold values)')
+    if args.progressive == 1 or args.progressive < 0:
+        parser.error('-ps/--progressive needs a stride of 2 or more')
+    if args.progressive and (args.block or args.incremental or args.group or any(len(values) > 1 for values in params.values())):
+        parser.error('-ps/--progressive cannot be used with -b/--block, -i/--incremental, -g/--group or a sweep')
+
+    prefetch = {'depth': args.prefetch_depth, 'read_size': args.read_size * 1024}
 
-    # Pattern identification
     path = f"{args.directory}".replace("\\", "/")
     proteins = os.listdir(path + "/TWN")
-    trajectory_path = path + "/trajectory"
-    boundary_path = path + "/boundary"
-    output_path = path + "/TWN-Pattern"
-    log_path = path + "/logs"
-    os.mkdir(output_path)
-    os.mkdir(log_path)
+    os.makedirs(path + "/TWN-Pattern", exist_ok=args.incremental)
+    os.makedirs(path + "/logs", exist_ok=args.incremental)
+    os.makedirs(path + "/TWN-Region", exist_ok=args.incremental)
+    os.makedirs(path + "/cache", exist_ok=True)
+    # group mode : one job per PDB code, running all of its ring types
+    groups = {}
     for protein in proteins:
-        os.mkdir(Path(output_path + '/' + protein))
-        os.mkdir(Path(log_path + '/' + protein))
-        trj = Path(trajectory_path + '/' + protein.split("_")[1] + '/a_input')
-        bd = Path(boundary_path + '/' + protein.split("_")[1] + '/Center.bd')
-        twn = Path(path + '/TWN/' + protein)
-        out = Path(output_path + '/' + protein)
-        log = Path(log_path + '/' + protein)
-        run = f"-trj {trj.as_posix()} -bd {bd.as_posix()} -twn {twn.as_posix()} -o {out.as_posix()} -l {log.as_posix()}"
-        subprocess.run(args=[sys.executable, 'TWN_Pattern.py'] + run.split(' '))
-
-    # Region identification
-    run = f"-d {Path(path).as_posix()}"
-    subprocess.run(args=[sys.executable, 'TWN_Region.py'] + run.split(' '))
\ No newline at end of file
+        groups.setdefault(protein.split("_")[1], []).append(protein)
+    units = len(groups) if args.group else len(proteins)
+    jobs = max(1, min(args.jobs, args.cpus // max(1, args.workers), units))
+    if jobs != args.jobs:
+        print(f"Jobs limited to {jobs} for {args.cpus} CPUs and {args.workers} workers per protein.")
+
+    start = time.time()
+    if args.group and jobs == 1:
+        summary = [row for code, group in groups.items()
+                   for row in group_pipeline(path, code, group, args.workers, False, args.profile, args.cprofile, args.incremental,
+                                             params, args.database, prefetch)]
+    elif args.group:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(group_pipeline, path, code, group, args.workers, True, args.profile, args.cprofile,
+                                   args.incremental, params, args.database, prefetch)
+                       for code, group in groups.items()]
+            summary = [row for future in futures for row in future.result()]
+    elif jobs == 1:
+        summary = [protein_pipeline(path, protein, args.workers, False, args.profile, args.cprofile, args.incremental, args.block, params,
+                                    args.database, args.progressive, args.top, prefetch)
+                   for protein in proteins]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(protein_pipeline, path, protein, args.workers, True, args.profile, args.cprofile, args.incremental,
+                                   args.block, params, args.database, args.progressive, args.top, prefetch)
+                       for protein in proteins]
+            summary = [future.result() for future in futures]
+
+    print(f"{'Protein':<30s}{'Status':<30s}{'Wall time (s)':>14s}")
+    for protein, status, wall_time in summary:
+        print(f"{protein:<30s}{status:<30s}{wall_time:>14.1f}")
+    print(f"Total {len(proteins)} proteins in {time.time() - start:.1f} s.")
@@ -0,0 +1,21 @@
+import time
+import argparse
+from pathlib import Path
+
+from TWN_Pattern import trajectory_frames, archive_writer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack trajectory frames into one memory-mapped frame archive.')
+    parser.add_argument('-trj', '--trajectory', required=True, help='Set your trajectory directory (a_input) to pack')
+    parser.add_argument('-o', '--output', required=True, help='Set your archive file (.twa)')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Set your number of parsing processes')
+    args = parser.parse_args()
+
+    output = Path(args.output)
+    if output.suffix != '.twa':
+        parser.error('the archive file must end with .twa')
+    start = time.time()
+    frames = trajectory_frames(args.trajectory)
+    n_frames = archive_writer(output, frames, args.workers)
+    print(f"{n_frames} frames packed into {output} in {time.time() - start:.1f} s.")
@@ -0,0 +1,162 @@
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+
+import TWN_Pattern
+import TWN_Region
+from TWN_Profile import peak_rss, peak_reset
+
+
+# water line of pdb format
+def water_line(atm_num, atm_type, residue_name, residue_index, coord, element):
+    return "{:6s}{:5d} {:^4s} {:3s} {:>4s}    {:8.3f}{:8.3f}{:8.3f}{:6.2f}{:6.2f}          {:>2s}".format(
+        'ATOM', atm_num % 100000, atm_type, residue_name, residue_index, coord[0], coord[1], coord[2], 1.0, 0.0, element)
+
+
+# water molecule (OW, HW1, HW2) around one oxygen
+def water_lines(atm_num, residue_name, residue_index, coord):
+    return [water_line(atm_num, 'OW', residue_name, residue_index, coord, 'O'),
+            water_line(atm_num + 1, 'HW1', residue_name, residue_index, coord + (0.6, 0.6, 0.0), 'H'),
+            water_line(atm_num + 2, 'HW2', residue_name, residue_index, coord + (-0.6, 0.6, 0.0), 'H')]
+
+
+# deterministic synthetic data set : trajectory frames, twn ring files and boundary file
+def synthetic_writer(inputpath, code, frames, density, twns, bd_range=10.0, site_fraction=0.3, seed=7):
+    rng = np.random.default_rng(seed)
+    trj_path = Path(inputpath) / 'trajectory' / code / 'a_input'
+    twn_path = Path(inputpath) / 'TWN' / f'BENCH_{code}_R4'
+    bd_path = Path(inputpath) / 'boundary' / code
+    for path in (trj_path, twn_path, bd_path):
+        path.mkdir(parents=True, exist_ok=True)
+
+    # waters fill a box around the boundary, a fraction of them sit on recurring hydration sites
+    center = np.array([1.7, 17.9, 43.0])
+    side = 2 * (bd_range + 3.0)
+    n_water = max(4, int(density * side ** 3))
+    sites = center + rng.uniform(-side / 2, side / 2, (int(n_water * site_fraction), 3))
+    residues = center + rng.uniform(-bd_range - 3.0, bd_range + 3.0, (40, 3))
+    twn_frames = np.sort(rng.integers(0, frames, twns))
+    bd_lines = [f'# Boundary file for TWN-Region-Analysis\n# PDB ID: {code}\n\nMETHOD  point\n\nRANGE  {bd_range}\n\n']
+    twn_count = {}
+    for frame in range(frames):
+        lines = ['REMARK    SYNTHETIC FRAME FOR TWN-Region-Analysis BENCHMARK', 'MODEL        1']
+        for idx, coord in enumerate(residues + rng.normal(0, 0.3, residues.shape)):
+            lines += ["ATOM  {:5d}  CA  ALA A{:4d}    {:8.3f}{:8.3f}{:8.3f}  1.00  0.00           C".format(idx + 1, idx + 1, *coord)]
+        lines += ['TER']
+        waters = np.concatenate([sites + rng.normal(0, 0.3, sites.shape),
+                                 center + rng.uniform(-side / 2, side / 2, (n_water - len(sites), 3))])
+        for idx, coord in enumerate(waters):
+            lines += water_lines(len(residues) + 1 + 3 * idx, 'SOL', str((idx + 1) % 10000), coord)
+        lines += ['TER', 'ENDMDL']
+        with open(trj_path / f'{frame}.pdb', 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        frame_center = center + rng.uniform(-0.2, 0.2, 3)
+        bd_lines += ["COORD  {:6d}  {:8.3f}  {:8.3f}  {:8.3f}\n".format(frame, *frame_center)]
+
+        # rings of four neighboring waters inside the boundary
+        inside = np.flatnonzero(np.linalg.norm(waters - frame_center, axis=1) <= bd_range - 1.0)
+        for _ in range(int(np.sum(twn_frames == frame))):
+            seed_water = waters[rng.choice(inside)] if len(inside) else waters[0]
+            ring = np.argsort(np.linalg.norm(waters - seed_water, axis=1))[:4]
+            twn_count[frame] = twn_count.get(frame, 0) + 1
+            ring_lines = []
+            for w in ring:
+                w_num = "{:0>6d}".format(w + 1)
+                ring_lines += water_lines(1 + 3 * w, 'W' + w_num[:2], w_num[2:], waters[w])
+            with open(twn_path / f'{code}_{frame}_rfour_{twn_count[frame]}.pdb', 'w') as f:
+                f.write("\n".join(ring_lines) + "\n")
+    with open(bd_path / 'Center.bd', 'w') as f:
+        f.write("".join(bd_lines))
+    return trj_path, twn_path, bd_path / 'Center.bd'
+
+
+# run one stage, record wall time, cpu time and memory
+def stage(results, name, trace, func, *args):
+    if trace:
+        tracemalloc.start()
+    scope = peak_reset()
+    wall, cpu = time.perf_counter(), time.process_time()
+    value = func(*args)
+    results[name] = {'wall_s': round(time.perf_counter() - wall, 4), 'cpu_s': round(time.process_time() - cpu, 4),
+                     'peak_rss_mb': peak_rss(), 'peak_rss_scope': scope}
+    if trace:
+        results[name]['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 3)
+        tracemalloc.stop()
+    print(f"{name:<20s}{results[name]['wall_s']:>10.3f} s")
+    return value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark TWN-Region-Analysis on synthetic trajectories.')
+    parser.add_argument('-o', '--output', required=True, help='Set your benchmark directory (synthetic data is written here)')
+    parser.add_argument('-f', '--frames', type=int, default=100, help='Set your number of trajectory frames')
+    parser.add_argument('-dn', '--density', type=float, default=0.0334, help='Set your water density (waters per A^3)')
+    parser.add_argument('-t', '--twn', type=int, default=200, help='Set your number of TWN ring files')
+    parser.add_argument('-s', '--seed', type=int, default=7, help='Set your random seed')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Set your number of parsing processes')
+    parser.add_argument('-e', '--engine', default='grid', choices=list(TWN_Pattern.search_engines.keys()), help='Set your neighbor search engine')
+    parser.add_argument('-b', '--block', type=int, default=0, help='Set your number of frames read at once (0 reads the whole trajectory)')
+    parser.add_argument('-pq', '--prefetch_depth', type=int, default=8, help='Set your number of files read ahead of the parser with -w 1 (0 reads each file when it is parsed)')
+    parser.add_argument('-rs', '--read_size', type=int, default=1024, help='Set your read size (KB) of prefetched files')
+    parser.add_argument('-m', '--memory', action='store_true', help='Trace peak Python memory per stage (slower)')
+    parser.add_argument('-r', '--results', default='benchmark.jsonl', help='Set your results file (one JSON record per run is appended)')
+    parser.add_argument('-lb', '--label', default='', help='Set your label for this run, e.g. a version')
+    args = parser.parse_args()
+    if args.block < 0:
+        parser.error('-b/--block must be 0 or a positive number of frames')
+    if args.prefetch_depth < 0:
+        parser.error('-pq/--prefetch_depth must be 0 or a positive number of files')
+    if args.read_size < 1:
+        parser.error('-rs/--read_size must be 1 KB or more')
+
+    inputpath = Path(args.output)
+    code = 'SYN'
+    protein = f'BENCH_{code}_R4'
+    config = {'frames': args.frames, 'density': args.density, 'twn': args.twn, 'seed': args.seed,
+              'workers': args.workers, 'engine': args.engine, 'block': args.block,
+              'prefetch_depth': args.prefetch_depth, 'read_size': args.read_size}
+    prefetch = {'depth': args.prefetch_depth, 'read_size': args.read_size * 1024}
+    marker = inputpath / 'benchmark.json'
+    if not marker.is_file() or json.loads(marker.read_text()) != {k: config[k] for k in ('frames', 'density', 'twn', 'seed')}:
+        if not marker.is_file() and inputpath.is_dir() and any(inputpath.iterdir()):
+            sys.exit(f'Value error: {inputpath} is not empty and is not a benchmark directory.\n')
+        print('Writing synthetic data...')
+        shutil.rmtree(inputpath, ignore_errors=True)
+        synthetic_writer(inputpath, code, args.frames, args.density, args.twn, seed=args.seed)
+        marker.write_text(json.dumps({k: config[k] for k in ('frames', 'density', 'twn', 'seed')}))
+    for out in ('TWN-Pattern', 'TWN-Region'):
+        shutil.rmtree(inputpath / out, ignore_errors=True)
+    (inputpath / 'TWN-Pattern' / protein).mkdir(parents=True)
+    (inputpath / 'TWN-Region' / protein).mkdir(parents=True)
+
+    stages = {}
+    twn = sorted(TWN_Pattern.pdb_files(inputpath / 'TWN' / protein))
+    trj = sorted(TWN_Pattern.trajectory_frames(inputpath / 'trajectory' / code / 'a_input'))
+    boundary = TWN_Pattern.boundary_reader(inputpath / 'boundary' / code / 'Center.bd')
+    twn_box = stage(stages, 'TWN_reader', args.memory, TWN_Pattern.TWN_reader, twn, args.workers, prefetch)
+    if args.block:
+        single_box = None
+        patterns = stage(stages, 'TWN_writer', args.memory, TWN_Pattern.TWN_chunk_writer, twn_box, trj, boundary,
+                         inputpath / 'TWN-Pattern' / protein / 'TWN.sdf', args.engine, args.block, args.workers, 1.0, 1.0, 2,
+                         prefetch)
+    else:
+        single_box = stage(stages, 'single_reader', args.memory, TWN_Pattern.single_reader, trj, boundary, args.workers, None, prefetch)
+        patterns = stage(stages, 'TWN_writer', args.memory, TWN_Pattern.TWN_writer, twn_box, single_box,
+                         inputpath / 'TWN-Pattern' / protein / 'TWN.sdf', args.engine)
+    regions = stage(stages, 'region_extractor', args.memory, TWN_Region.region_extractor, patterns, inputpath / 'TWN-Region' / protein)
+
+    record = {'label': args.label, 'time': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'numpy': np.__version__, 'config': config,
+              'counts': {'twn_files': len(twn), 'frames': len(trj), 'frame_waters': len(single_box['coord']) if single_box is not None else None,
+                         'patterns': len(patterns), 'regions': len(regions)},
+              'stages': stages}
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(record) + "\n")
+    print(f"Results appended to {args.results}")
@@ -1,9 +1,22 @@
+import io
+import os
+import csv
+import gzip
+import lzma
+import json
+import time
+import locale
+import hashlib
 import logging
 import argparse
+from itertools import repeat
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 from tqdm import tqdm
 from math import dist
 from pathlib import Path
+from TWN_Profile import stage, count, cprofile_start, cprofile_dump, profile_writer
 
 # module info option
 logger = logging.getLogger(__name__)
@@ -40,20 +53,39 @@ def trans_format(form, *vals):
     return trans[form].format(*vals)
 
 
+# parse boundary file once : method, range and centers by frame id
 def boundary_reader(boundary_file):
-    boundary_inform = []
+    boundary = {'method': '', 'range': 0.0, 'residues': [], 'centers': {}}
     with open(boundary_file, 'r') as f:
-        lines = f.readlines()
-        for line in lines:
+        for line in f:
+            items = line.split()
             if line.startswith('METHOD'):
-                boundary_inform += ["_".join(line.split()[1:]).rstrip()]
+                boundary['method'] = "_".join(items[1:])
             if line.startswith('RANGE'):
-                boundary_inform += [float(line.split()[1].strip())]
+                boundary['range'] = float(items[1])
             if line.startswith('COORD'):
-                boundary_inform += [[int(line.split()[1]), tuple((float(line.split()[2].strip()), float(line.split()[3].strip()), float(line.split()[4].strip())))]]
+                boundary['centers'].setdefault(str(int(items[1])), []).append([float(x) for x in items[2:5]])
             if line.startswith('RESIDUE'):
-                boundary_inform += ["-".join(line.split()[1:]).rstrip()]
-    return boundary_inform
+                boundary['residues'] += items[1:]
+    boundary['centers'] = {trj: np.array(coords, dtype=np.float64) for trj, coords in boundary['centers'].items()}
+    return boundary
+
+
+# boundary centers of one frame
+def boundary_centers(boundary, trajectory, residue_centers):
+    if boundary['method'] == 'residue_center_extraction':
+        if len(residue_centers) == 0:
+            return np.empty((0, 3), dtype=np.float64)
+        return np.mean(residue_centers, axis=0).reshape(1, 3)
+    return boundary['centers'].get(trajectory, np.empty((0, 3), dtype=np.float64))
+
+
+# waters inside the boundary of any center
+def boundary_mask(coords, centers, radius):
+    mask = np.zeros(len(coords), dtype=bool)
+    for center in centers:
+        mask |= within(coords, center, radius)
+    return mask
 
 
 def pdb_spliter(pdb_line):
@@ -73,197 +105,1098 @@ def pdb_spliter(pdb_line):
             x_coord, y_coord, z_coord, frequency, b_factor, element]
 
 
-# read protein
-def trajectory_reader(trajectory_file, boundary_file):
-    # boundary setting
-    boundary_inform = boundary_reader(boundary_file)
-    centers = []
+# stream one frame : sol oxygens and residue-center CA atoms in a single pass over its lines
+def frame_reader(lines, residues=(), protein=False):
+    protein_inform = []
     residue_centers = []
-    if boundary_inform[0] != 'residue_center_extraction':
-        for trj, coord in boundary_inform[2:]:
-            if trajectory_file.stem == str(trj):
-                centers += [coord]
-    # get protein inform
-    with open(trajectory_file, 'r') as f:
-        lines = f.readlines()
-        protein_inform = []
-        for line in lines:
-            line = line.rstrip()
-            atoms = pdb_spliter(line)
-
-            if atoms[0] != 'ATOM':
-                protein_inform += [line]
+    water_names = []
+    water_coords = []
+    first_num = None
+    ht = 0
+    for line in lines:
+        residue_name = line[17:20].strip()
+        if residue_name == 'SOL':
+            # save atom number
+            atm_num = int(line[6:11])
+            if atm_num == 0:
+                ht += 100000
+            atm_num += ht
+            # define first atom
+            if first_num is None:
+                first_num = atm_num
+            if line[11:17].strip() == 'OW':
+                w_num = "{:0>6d}".format(int((atm_num - first_num) / 3 + 1))
+                water_names += ['W' + w_num[:2] + str(int(w_num[2:]))]
+                water_coords += [(float(line[30:38]), float(line[38:46]), float(line[46:54]))]
+            # non-ATOM sol records still go to the protein lines
+            if not protein or line[0:6].strip() == 'ATOM':
                 continue
+        if not line.startswith('ATOM'):
+            if protein:
+                protein_inform += [line.rstrip()]
+            continue
+        if residue_name == 'CL' or residue_name == 'NA':
+            continue
+        if residues and line[11:17].strip() == 'CA' and residue_name + line[22:26].strip() in residues:
+            residue_centers += [(float(line[30:38]), float(line[38:46]), float(line[46:54]))]
+        if protein:
+            atoms = pdb_spliter(line.rstrip())
+            protein_inform += [trans_format('pdb_line', atoms[0], int(atoms[1]), atoms[2], '', atoms[3], atoms[4], int(atoms[5]), '',
+                                            float(atoms[6]), float(atoms[7]), float(atoms[8]),
+                                            float(atoms[9]), float(atoms[10]), atoms[11], '')]
+    return protein_inform, residue_centers, np.array(water_names, dtype=str), np.array(water_coords, dtype=np.float64).reshape(-1, 3)
 
-            elif atoms[3] == 'SOL' or atoms[3] == 'CL' or atoms[3] == 'NA':
-                continue
 
-            else:
-                if boundary_inform[0] == 'residue_center_extraction' and (atoms[3] + atoms[5]) in boundary_inform[2].split("-") and atoms[2] == 'CA':
-                    residue_centers += [tuple((float(atoms[6]), float(atoms[7]), float(atoms[8])))]
-                pdb_row = trans_format('pdb_line', atoms[0], int(atoms[1]), atoms[2], '', atoms[3], atoms[4], int(atoms[5]), '',
-                                       float(atoms[6]), float(atoms[7]), float(atoms[8]),
-                                       float(atoms[9]), float(atoms[10]), atoms[11], '')
-                protein_inform += [pdb_row]
-        if len(residue_centers) != 0:
-            centers = [np.mean(residue_centers, axis=0)]
-        water_inform = []
-        first_atm = True
-        ht = 0
-        for line in lines:
-            line = line.rstrip()
-            atoms = pdb_spliter(line)
-
-            if atoms[3] == 'SOL':
-                # save atom number
-                if int(atoms[1]) == 0:
-                    ht += 100000
-                atm_num = int(atoms[1]) + ht
-                # define first atom
-                if first_atm:
-                    first_num = atm_num
-                    first_atm = False
-                if atoms[2] == 'OW':
-                    w_num = int((atm_num-first_num)/3 + 1)
-                    if any([dist((float(atoms[6]), float(atoms[7]), float(atoms[8])), center) <= boundary_inform[1] for center in centers]):
-                        water_row = trans_format('pdb_line', atoms[0], int(atoms[1]), atoms[2], '', 'W' + "{:0>6d}".format(w_num)[:2], '', int("{:0>6d}".format(w_num)[2:]), '',
-                                                 float(atoms[6]), float(atoms[7]), float(atoms[8]),
-                                                 float(atoms[9]), float(atoms[10]), atoms[11], '')
-                        water_inform += [water_row]
-    return protein_inform, water_inform
-
-
-# read single water
-def single_reader(trj, boundary_file):
-    single_box = {}
-    for trajectory_file in tqdm(trj):
-        trajectory = trajectory_file.stem
-        file_box = []
-        lines = trajectory_reader(trajectory_file, boundary_file)[1]
-        for line in lines:
-            atoms = pdb_spliter(line)
-            if atoms[2] != 'OW':
-                continue
-            if len(atoms) == 11:
-                atoms += ['O']
-            if len(atoms) != 12:
+# rows of the waters inside the boundary of one frame
+def boundary_keep(boundary, trajectory, residue_centers, water_coords):
+    centers = boundary_centers(boundary, trajectory, residue_centers)
+    return np.flatnonzero(boundary_mask(water_coords, centers, boundary['range']))
+
+
+def boundary_residues(boundary):
+    return boundary['residues'] if boundary['method'] == 'residue_center_extraction' else []
+
+
+# pdb text, gzip (.gz) and xz (.xz) compressed files are decompressed while reading
+# raw bytes already read (data) are opened the same way as the file they came from
+def pdb_open(pdb_file, mode='r', data=None):
+    source = pdb_file if data is None else io.BytesIO(data)
+    if str(pdb_file).endswith('.gz'):
+        return gzip.open(source, mode + 't' if mode == 'r' else mode)
+    if str(pdb_file).endswith('.xz'):
+        return lzma.open(source, mode + 't' if mode == 'r' else mode)
+    return open(pdb_file, mode) if data is None else io.TextIOWrapper(source)
+
+
+# file name without .pdb and compression suffixes
+def pdb_name(pdb_file):
+    name = Path(pdb_file).name
+    for suffix in ('.gz', '.xz', '.pdb'):
+        name = name[:-len(suffix)] if name.endswith(suffix) else name
+    return name
+
+
+# plain and compressed pdb files of a directory, by name
+def pdb_files(path):
+    return sorted([pdb for pattern in ('./*.pdb', './*.pdb.gz', './*.pdb.xz') for pdb in Path(path).glob(pattern)],
+                  key=pdb_name)
+
+
+# offsets of the MODEL records of a pdb file, in bytes of its (decompressed) text
+def model_offsets(pdb_file):
+    offsets = []
+    position = 0
+    with pdb_open(pdb_file, 'rb') as f:
+        for line in f:
+            if line.startswith(b'MODEL'):
+                offsets += [position]
+            position += len(line)
+    return offsets
+
+
+# compressed container left open by this process, so that frame blocks read one after another continue its
+# decompression instead of starting again from the top of the file
+container_streams = {}
+
+
+# binary stream of a pdb file at offset, the plain ones are simply seeked
+def container_stream(pdb_file, offset):
+    if not str(pdb_file).endswith(('.gz', '.xz')):
+        f = pdb_open(pdb_file, 'rb')
+        f.seek(offset)
+        return f
+    key = (str(pdb_file), tuple(file_stamp(pdb_file)))
+    f = container_streams.pop(key, None)
+    if f is not None and f.tell() > offset:
+        f.close()
+        f = None
+    if f is None:
+        f = pdb_open(pdb_file, 'rb')
+    for other in container_streams.values():
+        other.close()
+    container_streams.clear()
+    container_streams[key] = f
+    f.seek(offset)
+    return f
+
+
+# lines of the wanted models of a multi-model pdb file, split on MODEL/ENDMDL; models are given by the offsets of their
+# MODEL records (model_offsets), reading starts at the first wanted model and stops after the last one
+def model_lines(pdb_file, models):
+    wanted = set(models)
+    models = sorted(wanted)
+    encoding = locale.getpreferredencoding(False)
+    f = container_stream(pdb_file, models[0])
+    position = models[0]
+    model = None
+    lines = None
+    try:
+        for line in f:
+            if line.startswith(b'MODEL'):
+                model = position
+                lines = [] if model in wanted else None
+            position += len(line)
+            if lines is None:
                 continue
-            single_data = [atoms[1], atoms[2], trajectory, atoms[3] + atoms[5],
-                        float(atoms[6]), float(atoms[7]), float(atoms[8]),
-                        float(atoms[9]), float(atoms[10]), atoms[11]]
-            file_box += [single_data]
-        single_box[trajectory] = file_box
+            lines += [line.decode(encoding).replace('\r\n', '\n')]
+            if line.startswith(b'ENDMDL'):
+                yield model, lines
+                lines = None
+                if model >= models[-1]:
+                    return
+        if lines is not None:
+            yield model, lines
+    finally:
+        if f not in container_streams.values():
+            f.close()
+
+
+# frames of a trajectory directory : (file, frame id, model)
+# a pdb file named by its frame id is one frame (model None); models of multi-model pdb files are numbered
+# from 0 in file name order and keep the offset of their MODEL record, frame archives (.twa) keep the frame ids
+# they were packed with; other single-model pdb files (e.g. a reference structure) are not frames. frames are listed
+# by frame id, not in directory order, so the frame columns of every output are the same for any copy of the data
+def trajectory_frames(trajectory_path):
+    frames = []
+    containers = {}
+    for pdb in pdb_files(trajectory_path):
+        if pdb_name(pdb).isdigit():
+            frames += [(pdb, pdb_name(pdb), None)]
+            continue
+        offsets = model_offsets(pdb)
+        if len(offsets) > 1:
+            containers[pdb] = offsets
+        else:
+            logger.info(f'Skip {pdb} : not a frame (no frame id name, one model)')
+    n_model = 0
+    for container in sorted(list(containers) + list(Path(trajectory_path).glob('./*.twa')), key=lambda x: x.name):
+        if container.suffix == '.twa':
+            frames += [(container, trj, model) for model, trj in enumerate(archive_reader(container)['frames'])]
+        else:
+            frames += [(container, str(n_model + idx), offset) for idx, offset in enumerate(containers[container])]
+            n_model += len(containers[container])
+    return sorted(frames, key=lambda frame: int(frame[1]))
+
+
+# frames grouped by file, in order of first appearance : (file, [(frame id, model)])
+def frame_groups(trj):
+    groups = {}
+    for trajectory_file, frame, model in trj:
+        groups.setdefault(trajectory_file, []).append((frame, model))
+    return list(groups.items())
+
+
+# frame archive : frame blocks (oxygen coords, CA coords, oxygen name ids, CA key ids) then a json footer
+# and its length, read back memory-mapped with one zero-copy view per frame
+archive_magic = b'TWNARC1\n'
+
+
+def archive_reader(archive_file):
+    data = np.memmap(archive_file, dtype=np.uint8, mode='r')
+    if bytes(data[:len(archive_magic)]) != archive_magic:
+        raise ValueError(f'{archive_file} is not a frame archive')
+    size = int(data[-8:].view('<u8')[0])
+    archive = json.loads(bytes(data[-8 - size:-8]).decode())
+    archive['data'] = data
+    return archive
+
+
+def archive_frame(archive, model):
+    start, n, m = archive['start'][model], archive['waters'][model], archive['cas'][model]
+    data = archive['data']
+    coord = np.frombuffer(data, np.float64, 3 * n, start).reshape(n, 3)
+    ca_coord = np.frombuffer(data, np.float64, 3 * m, start + 24 * n).reshape(m, 3)
+    name = np.frombuffer(data, np.int32, n, start + 24 * (n + m))
+    ca_key = np.frombuffer(data, np.int32, m, start + 24 * (n + m) + 4 * n)
+    return coord, name, ca_coord, ca_key
+
+
+# sol oxygens and all CA atoms of the frames of one file, for packing
+def pack_loader(frame_group):
+    trajectory_file, frames = frame_group
+    if frames[0][1] is None:
+        with pdb_open(trajectory_file) as f:
+            frame_lines = [(None, f.readlines())]
+    else:
+        frame_lines = list(model_lines(trajectory_file, [model for trj, model in frames]))
+    packed = []
+    for model, lines in frame_lines:
+        cas = [(line[17:20].strip() + line[22:26].strip(), line[22:26].strip(),
+                (float(line[30:38]), float(line[38:46]), float(line[46:54]))) for line in lines
+               if line.startswith('ATOM') and line[17:20].strip() not in ('SOL', 'CL', 'NA') and line[11:17].strip() == 'CA']
+        _, _, water_names, water_coords = frame_reader(lines)
+        packed += [(water_names, water_coords, cas)]
+    return packed
+
+
+# pack the frames of a trajectory directory into one archive
+def archive_writer(archive_file, trj, workers=1):
+    footer = {'frames': [], 'start': [], 'waters': [], 'cas': [], 'names': [], 'keys': [], 'key_numbers': []}
+    names = {}
+    keys = {}
+    groups = frame_groups(trj)
+    tmp_file = f"{archive_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(archive_magic)
+        for (trajectory_file, frames), packed in zip(groups, file_mapper(pack_loader, groups, workers)):
+            for (trj, model), (water_names, water_coords, cas) in zip(frames, packed):
+                footer['frames'] += [trj]
+                footer['start'] += [f.tell()]
+                footer['waters'] += [len(water_names)]
+                footer['cas'] += [len(cas)]
+                for key, number, coord in cas:
+                    if key not in keys:
+                        keys[key] = len(keys)
+                        footer['key_numbers'] += [number]
+                f.write(np.ascontiguousarray(water_coords, dtype=np.float64).tobytes())
+                f.write(np.array([coord for key, number, coord in cas], dtype=np.float64).reshape(-1, 3).tobytes())
+                f.write(np.array([names.setdefault(name, len(names)) for name in water_names.tolist()], dtype=np.int32).tobytes())
+                f.write(np.array([keys[key] for key, number, coord in cas], dtype=np.int32).tobytes())
+                f.write(b'\0' * (-f.tell() % 8))
+        footer['names'] = list(names.keys())
+        footer['keys'] = list(keys.keys())
+        text = json.dumps(footer).encode()
+        f.write(text)
+        f.write(np.array([len(text)], dtype='<u8').tobytes())
+    os.replace(tmp_file, archive_file)
+    return len(footer['frames'])
+
+
+# read protein
+def trajectory_reader(trajectory_file, boundary, protein=True, data=None):
+    with pdb_open(trajectory_file, data=data) as f:
+        protein_inform, residue_centers, water_names, water_coords = frame_reader(f, boundary_residues(boundary), protein)
+    keep = boundary_keep(boundary, pdb_name(trajectory_file), residue_centers, water_coords)
+    return protein_inform, (water_names[keep], water_coords[keep])
+
+
+# columnar water store : one row per oxygen, labels interned per set
+def water_store(file_box):
+    names = {}
+    labels = []
+    coords = [np.empty((0, 3), dtype=np.float64)]
+    offset = [0]
+    for water_names, water_coords in file_box.values():
+        labels += [np.array([names.setdefault(name, len(names)) for name in np.asarray(water_names).tolist()], dtype=np.int32)]
+        coords += [np.asarray(water_coords, dtype=np.float64).reshape(-1, 3)]
+        offset += [offset[-1] + len(water_names)]
+    offset = np.array(offset, dtype=np.int64)
+    return {'files': list(file_box.keys()), 'offset': offset,
+            'file': np.repeat(np.arange(len(file_box), dtype=np.int32), np.diff(offset)),
+            'coord': np.concatenate(coords), 'name': np.concatenate(labels + [np.empty(0, dtype=np.int32)]),
+            'names': list(names.keys())}
+
+
+# oxygen names and coordinates of twn pdb lines
+def water_rows(lines):
+    water_names = []
+    water_coords = []
+    for line in lines:
+        atoms = pdb_spliter(line.rstrip())
+        if atoms[2] != 'OW':
+            continue
+        water_names += [atoms[3] + atoms[5]]
+        water_coords += [(float(atoms[6]), float(atoms[7]), float(atoms[8]))]
+    return np.array(water_names, dtype=str), np.array(water_coords, dtype=np.float64).reshape(-1, 3)
+
+
+# raw bytes of one file, read in chunks of read_size
+def file_bytes(file, read_size=1 << 20):
+    if read_size <= 0:
+        raise ValueError('read_size must be a positive number of bytes')
+    chunks = []
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(read_size), b''):
+            chunks += [chunk]
+    return b''.join(chunks)
+
+
+# map files in order on threads prefetching the raw bytes of up to depth files ahead of the parser (prefetch
+# {'depth', 'read_size'}); path gives the file to read for an item, None when the loader reads it itself
+def prefetch_mapper(loader, files, prefetch, path, *args):
+    if prefetch['read_size'] <= 0:
+        raise ValueError('read_size must be a positive number of bytes')
+    io_wait = parse = 0.0
+    bytes_read = 0
+    results = []
+    items = iter(files)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=prefetch['depth']) as pool:
+        # back-pressure : a new read starts only when one is taken, at most depth files are held
+        def submit():
+            for item in items:
+                file = path(item)
+                pending.append((item, pool.submit(file_bytes, file, prefetch['read_size']) if file is not None else None))
+                return
+        for _ in range(prefetch['depth']):
+            submit()
+        with tqdm(total=len(files)) as bar:
+            while pending:
+                item, future = pending.popleft()
+                start = time.perf_counter()
+                data = future.result() if future is not None else None
+                io_wait += time.perf_counter() - start
+                submit()
+                start = time.perf_counter()
+                results += [loader(item, *args, data=data)]
+                parse += time.perf_counter() - start
+                bytes_read += len(data) if data is not None else 0
+                bar.update()
+    logger.info(f'Prefetch : {len(results)} files, {bytes_read / 2 ** 20:.1f} MB read ahead (depth {prefetch["depth"]}), '
+                f'I/O wait {io_wait:.2f} s, parse {parse:.2f} s')
+    count('io_wait_ms', io_wait * 1000)
+    count('parse_ms', parse * 1000)
+    count('bytes_prefetched', bytes_read)
+    return results
+
+
+# map files in order, over a process pool when workers > 1, with prefetched reads when prefetch is given (workers <= 1)
+def file_mapper(loader, files, workers=1, *args, prefetch=None, path=None):
+    if workers <= 1 and prefetch and prefetch['depth'] > 0 and len(files):
+        return prefetch_mapper(loader, files, prefetch, path if path is not None else lambda file: file, *args)
+    if workers <= 1:
+        return [loader(file, *args) for file in tqdm(files)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunk = max(1, len(files) // (workers * 8))
+        return list(tqdm(pool.map(loader, files, *[repeat(arg) for arg in args], chunksize=chunk), total=len(files)))
+
+
+# file of a frame group read in one piece, None for containers read frame by frame
+def frame_file(frame_group):
+    return frame_group[0] if frame_group[1][0][1] is None else None
+
+
+# boundary filtered waters of the frames of one file, from its raw bytes (data) when already read
+def single_loader(frame_group, boundary, data=None):
+    trajectory_file, frames = frame_group
+    if trajectory_file.suffix == '.twa':
+        archive = archive_reader(trajectory_file)
+        names = np.array(archive['names'], dtype=str)
+        keys = np.array(archive['keys'], dtype=str)
+        waters = []
+        for trj, model in frames:
+            coord, name, ca_coord, ca_key = archive_frame(archive, model)
+            residue_centers = ca_coord[np.isin(keys[ca_key], boundary_residues(boundary))]
+            keep = boundary_keep(boundary, trj, residue_centers, coord)
+            waters += [(names[name[keep]], coord[keep])]
+        return waters
+    if frames[0][1] is None:
+        return [trajectory_reader(trajectory_file, boundary, protein=False, data=data)[1]]
+    trjs = {model: trj for trj, model in frames}
+    waters = {}
+    for model, lines in model_lines(trajectory_file, trjs):
+        _, residue_centers, water_names, water_coords = frame_reader(lines, boundary_residues(boundary))
+        keep = boundary_keep(boundary, trjs[model], residue_centers, water_coords)
+        waters[model] = (water_names[keep], water_coords[keep])
+    return [waters[model] for trj, model in frames]
+
+
+# waters of one twn file, from its raw bytes (data) when already read
+def twn_loader(twn_file, data=None):
+    with pdb_open(twn_file, data=data) as f:
+        return water_rows(f.readlines())
+
+
+# cache key of the parsed boundary : method, range, residues and centers
+def boundary_key(boundary):
+    key = hashlib.sha1(f"{boundary['method']} {boundary['range']} {' '.join(boundary['residues'])}".encode())
+    for trj, centers in boundary['centers'].items():
+        key.update(trj.encode())
+        key.update(centers.tobytes())
+    return key.hexdigest()
+
+
+# size and modification time of a frame file
+def file_stamp(file):
+    stat = os.stat(file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# cached frames : stem -> (stamp, (names, coords)), empty if the boundary changed
+def frame_cache_reader(cache_file, boundary):
+    if cache_file is None or not os.path.isfile(cache_file):
+        return {}
+    frames = {}
+    with np.load(cache_file) as cache:
+        if str(cache['boundary']) != boundary_key(boundary):
+            return {}
+        names = cache['names']
+        offset = cache['offset']
+        for idx, (trj, stamp) in enumerate(zip(cache['files'].tolist(), cache['stamps'].tolist())):
+            rows = slice(offset[idx], offset[idx + 1])
+            frames[trj] = (stamp, (names[cache['name'][rows]], cache['coord'][rows]))
+    return frames
+
+
+# save the water store of all frames with their file stamps
+def frame_cache_writer(cache_file, boundary, single_box, stamps):
+    tmp_file = f"{cache_file}.{os.getpid()}.npz"
+    np.savez(tmp_file, boundary=boundary_key(boundary), files=np.array(single_box['files'], dtype=str),
+             stamps=np.array(stamps, dtype=np.int64).reshape(-1, 2), offset=single_box['offset'],
+             coord=single_box['coord'], name=single_box['name'], names=np.array(single_box['names'], dtype=str))
+    os.replace(tmp_file, cache_file)
+
+
+# read single water, frames unchanged since the cache was written are not parsed again
+def single_reader(trj, boundary, workers=1, cache_file=None, prefetch=None):
+    stamps = [file_stamp(trajectory_file) for trajectory_file, trajectory, model in trj]
+    cached = frame_cache_reader(cache_file, boundary)
+    frames = {trajectory: cached[trajectory][1] for (trajectory_file, trajectory, model), stamp in zip(trj, stamps)
+              if trajectory in cached and cached[trajectory][0] == stamp}
+    todo = frame_groups([frame for frame in trj if frame[1] not in frames])
+    if cache_file is not None:
+        logger.info(f'Frame cache : {len(frames)} frames reused, {len(trj) - len(frames)} frames parsed')
+    todo_waters = file_mapper(single_loader, todo, workers, boundary, prefetch=prefetch, path=frame_file)
+    for (trajectory_file, group), waters in zip(todo, todo_waters):
+        for (trajectory, model), water in zip(group, waters):
+            frames[trajectory] = water
+    single_box = water_store({trajectory: frames[trajectory] for trajectory_file, trajectory, model in trj})
+    single_box['stamps'] = stamps
+    count('files_parsed', len(todo))
+    count('files_cached', len(frame_groups(trj)) - len(todo))
+    count('waters_kept', len(single_box['coord']))
+    if cache_file is not None and (todo or len(cached) != len(trj)):
+        frame_cache_writer(cache_file, boundary, single_box, stamps)
     return single_box
 
 
 # read twn water
-def TWN_reader(twn):
-    twn_box = {}
-    twn_atom_num = 1
-    for twn_file in tqdm(twn):
-        twn_name = twn_file.stem
-        file_box = []
-        with open(twn_file, 'r') as f:
-            lines = f.readlines()
-            for line in lines:
-                line = line.rstrip()
-                atoms = pdb_spliter(line)
-                if atoms[2] != 'OW':
-                    continue
-                if len(atoms) == 11:
-                    atoms += ['O']
-                if len(atoms) != 12:
-                    continue
-                twn_data = [twn_atom_num, atoms[2], twn_name, atoms[3] + atoms[5],
-                            float(atoms[6]), float(atoms[7]), float(atoms[8]),
-                            float(atoms[9]), float(atoms[10]), atoms[11]]
-                file_box += [twn_data]
-            twn_atom_num += 1
-            twn_box[twn_name] = file_box
+def TWN_reader(twn, workers=1, prefetch=None):
+    waters = file_mapper(twn_loader, twn, workers, prefetch=prefetch)
+    count('files_parsed', len(twn))
+    twn_box = water_store({pdb_name(twn_file): water for twn_file, water in zip(twn, waters)})
+    twn_box['stamps'] = [file_stamp(twn_file) for twn_file in twn]
+    count('twn_waters', len(twn_box['coord']))
     return twn_box
 
 
+# distance mask, cutoff decided by math.dist like the scalar code
+def within(coords, point, radius):
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    d = np.sqrt(((coords - np.asarray(point, dtype=np.float64)) ** 2).sum(axis=1))
+    return distance_mask(d, coords, point, radius)
+
+
+# cutoff of distances already computed, math.dist decides the ones at the cutoff
+def distance_mask(d, coords, point, radius):
+    mask = d <= radius
+    for i in np.flatnonzero(np.abs(d - radius) <= 1e-9):
+        mask[i] = dist(tuple(point), tuple(coords[i].tolist())) <= radius
+    return mask
+
+
+# neighbor search : brute force
+def brute_engine(coords, radius):
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+
+    def query(points):
+        count('index_queries', len(points))
+        count('distance_evaluations', len(coords) * len(points))
+        return [np.flatnonzero(within(coords, point, radius)) for point in points]
+    return query
+
+
+# neighbor search : uniform grid, cell size = radius
+def grid_key(cells):
+    cells = cells + (1 << 20)
+    return (cells[..., 0] << 42) | (cells[..., 1] << 21) | cells[..., 2]
+
+
+def grid_engine(coords, radius):
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    keys = grid_key(np.floor(coords / radius).astype(np.int64))
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    shifts = np.array([(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)], dtype=np.int64)
+
+    def query(points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        near_keys = grid_key(np.floor(points / radius).astype(np.int64)[:, None, :] + shifts)
+        lo = np.searchsorted(sorted_keys, near_keys, 'left')
+        hi = np.searchsorted(sorted_keys, near_keys, 'right')
+        found = []
+        for point, l, h in zip(points, lo, hi):
+            cand = np.sort(np.concatenate([order[a:b] for a, b in zip(l, h)]))
+            found += [cand[within(coords[cand], point, radius)]]
+            count('distance_evaluations', len(cand))
+        count('index_queries', len(points))
+        return found
+    return query
+
+
+search_engines = {'brute': brute_engine, 'grid': grid_engine}
+
+
+# incremental grid over a growing point set, cell size = radius
+def grid_index(radius):
+    cells = {}
+    points = []
+
+    def add(new_points):
+        for point in np.asarray(new_points, dtype=np.float64).reshape(-1, 3):
+            cells.setdefault(tuple(np.floor(point / radius).astype(np.int64).tolist()), []).append(len(points))
+            points.append(point)
+
+    def query(query_points):
+        found = []
+        for point in np.asarray(query_points, dtype=np.float64).reshape(-1, 3):
+            cx, cy, cz = np.floor(point / radius).astype(np.int64).tolist()
+            cand = np.array(sorted(idx for x in (cx - 1, cx, cx + 1) for y in (cy - 1, cy, cy + 1) for z in (cz - 1, cz, cz + 1)
+                                   for idx in cells.get((x, y, z), [])), dtype=np.int64)
+            found += [cand[within(np.array([points[idx] for idx in cand]), point, radius)]]
+            count('distance_evaluations', len(cand))
+        count('index_queries', len(found))
+        return found
+    return add, query
+
+
+# matched waters of one center water : {trajectory: water name}, waters of the twn's own trajectory are left out
+def center_matches(single_box, near, own_trj):
+    near = near[single_box['file'][near] != own_trj]
+    return {single_box['files'][f]: single_box['names'][n] for f, n in zip(single_box['file'][near], single_box['name'][near])}
+
+
+# occupancy table : twn -> center water -> {trajectory: water name}
+# only twn files and frames that are new (or changed since the table was made) are matched
+def TWN_occupancy(twn_box, single_box, engine='grid', table=None, radius=1.0):
+    table = table if table is not None else {'frames': {}, 'twns': {}}
+    frame_stamps = dict(zip(single_box['files'], single_box.get('stamps', [None] * len(single_box['files']))))
+    twn_stamps = dict(zip(twn_box['files'], twn_box.get('stamps', [None] * len(twn_box['files']))))
+    new_frames = set(trj for trj, stamp in frame_stamps.items() if stamp is None or table['frames'].get(trj) != stamp)
+    new_twns = set(twn for twn, stamp in twn_stamps.items()
+                   if stamp is None or twn not in table['twns'] or table['twns'][twn]['stamp'] != stamp)
+    logger.info(f'Occupancy table : {len(twn_stamps) - len(new_twns)} TWN files reused, {len(new_twns)} matched; '
+                f'{len(frame_stamps) - len(new_frames)} frames reused, {len(new_frames)} matched')
+
+    # one stacked index over the waters of every frame, and one over the new frames for reused twn files
+    frame_index = {trj: idx for idx, trj in enumerate(single_box['files'])}
+    new_rows = np.flatnonzero(np.isin(single_box['file'], [frame_index[trj] for trj in new_frames]))
+    search_all = search_engines[engine](single_box['coord'], radius) if new_twns else None
+    search_new = search_engines[engine](single_box['coord'][new_rows], radius) if len(new_twns) < len(twn_stamps) else None
+    twns = {}
+    for t_idx, twn_name in enumerate(twn_box['files']):
+        rows = slice(twn_box['offset'][t_idx], twn_box['offset'][t_idx + 1])
+        own_trj = frame_index.get(twn_name.split("_")[1], -1)
+        if twn_name in new_twns:
+            search, row_map, centers = search_all, None, {}
+        else:
+            search, row_map = search_new, new_rows
+            centers = {c_name: {trj: w_name for trj, w_name in matches.items() if trj in frame_stamps and trj not in new_frames}
+                       for c_name, matches in table['twns'][twn_name]['centers'].items()}
+        tmp_TWN_pattern = {}
+        for c_name, near in zip(twn_box['name'][rows], search(twn_box['coord'][rows])):
+            near = near if row_map is None else row_map[near]
+            tmp_TWN_pattern[twn_box['names'][c_name]] = center_matches(single_box, near, own_trj)
+        for c_name, matches in tmp_TWN_pattern.items():
+            centers.setdefault(c_name, {}).update(matches)
+        twns[twn_name] = {'stamp': twn_stamps[twn_name], 'centers': centers}
+    table['frames'] = frame_stamps
+    table['twns'] = twns
+    return table
+
+
+# neighbors of every twn row within the largest radius of a sweep : (water rows, distances)
+def match_neighbors(twn_box, single_box, engine='grid', radius=1.0):
+    near = search_engines[engine](single_box['coord'], radius)(twn_box['coord'])
+    return [(rows, np.sqrt(((single_box['coord'][rows] - point) ** 2).sum(axis=1))) for rows, point in zip(near, twn_box['coord'])]
+
+
+# occupancy table at a match radius up to the one the neighbors were searched with
+def neighbor_occupancy(twn_box, single_box, neighbors, radius=1.0):
+    frame_index = {trj: idx for idx, trj in enumerate(single_box['files'])}
+    twns = {}
+    for t_idx, twn_name in enumerate(twn_box['files']):
+        own_trj = frame_index.get(twn_name.split("_")[1], -1)
+        centers = {}
+        for row in range(twn_box['offset'][t_idx], twn_box['offset'][t_idx + 1]):
+            near, d = neighbors[row]
+            near = near[distance_mask(d, single_box['coord'][near], twn_box['coord'][row], radius)]
+            centers[twn_box['names'][twn_box['name'][row]]] = center_matches(single_box, near, own_trj)
+        twns[twn_name] = {'stamp': None, 'centers': centers}
+    return {'frames': {}, 'twns': twns}
+
+
+# saved occupancy table, an empty one if missing or made with another boundary or match radius
+def occupancy_reader(table_file, boundary, radius=1.0):
+    table = {'boundary': boundary_key(boundary), 'radius': radius, 'frames': {}, 'twns': {}}
+    if table_file is not None and os.path.isfile(table_file):
+        with open(table_file, 'r') as f:
+            saved = json.load(f)
+        if saved.get('boundary') == table['boundary'] and saved.get('radius', 1.0) == radius:
+            table.update(saved)
+    return table
+
+
+def occupancy_writer(table_file, table):
+    tmp_file = f"{table_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(table, f)
+    os.replace(tmp_file, table_file)
+
+
+# occupancy matrix : bit-packed twn x frame occupancy (every center water matched in the frame),
+# water name ids of the occupied cells (one row per occupied frame, one column per center) and the name table
+def occupancy_matrix(twn_box, table, all_trj):
+    column = {trj: idx for idx, trj in enumerate(all_trj)}
+    names = {}
+    occupancy = {'frames': list(all_trj), 'centers': [], 'water': [],
+                 'occupied': np.zeros((len(twn_box['files']), (len(all_trj) + 7) // 8), dtype=np.uint8)}
+    for t_idx, twn_name in enumerate(twn_box['files']):
+        centers = table['twns'][twn_name]['centers']
+        water = np.full((len(centers), len(all_trj)), -1, dtype=np.int32)
+        for c_idx, matches in enumerate(centers.values()):
+            cells = [(column[trj], names.setdefault(w_name, len(names))) for trj, w_name in matches.items() if trj in column]
+            if cells:
+                cols, ids = zip(*cells)
+                water[c_idx, list(cols)] = ids
+        occupied = np.all(water >= 0, axis=0)
+        occupancy['occupied'][t_idx] = np.packbits(occupied)
+        occupancy['water'] += [water[:, occupied].T]
+        occupancy['centers'] += [list(centers.keys())]
+    occupancy['names'] = list(names.keys())
+    return occupancy
+
+
+bit_count = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.int64)
+
+
+# frequency of each twn : own trajectory plus the occupied frames other than it
+def occupancy_frequency(twn_box, occupancy):
+    column = {trj: idx for idx, trj in enumerate(occupancy['frames'])}
+    own = np.array([column.get(twn_name.split("_")[1], -1) for twn_name in twn_box['files']], dtype=np.int64)
+    rows = np.flatnonzero(own >= 0)
+    own_bit = np.zeros(len(own), dtype=np.int64)
+    own_bit[rows] = (occupancy['occupied'][rows, own[rows] >> 3] >> (7 - (own[rows] & 7))) & 1
+    return 1 + bit_count[occupancy['occupied']].sum(axis=1) - own_bit
+
+
+# trajectories and water names of one twn : own trajectory with its center names first, then occupied frames
+def occupancy_record(twn_box, occupancy, t_idx):
+    own = twn_box['files'][t_idx].split("_")[1]
+    cols = np.flatnonzero(np.unpackbits(occupancy['occupied'][t_idx], count=len(occupancy['frames'])))
+    trjs = [own]
+    w_names = ["-".join(occupancy['centers'][t_idx])]
+    for col, ids in zip(cols.tolist(), occupancy['water'][t_idx].tolist()):
+        if occupancy['frames'][col] != own:
+            trjs += [occupancy['frames'][col]]
+            w_names += ["-".join([occupancy['names'][w_id] for w_id in ids])]
+    return trjs, w_names
+
+
 # write twn water
-def TWN_writer(twn_box, single_box, twn_out):
+def TWN_writer(twn_box, single_box, twn_out=None, engine='grid', table=None, radius=1.0, unique_radius=1.0, min_frequency=2):
     logger.info(f'Start identifying TWN-Patterns...')
-    TWN_patterns = {}
-    for twn_name, twn_data in twn_box.items():
-        tmp_TWN_pattern = {}
-        TWN_patterns[twn_name] = {}
-        for cluster_center in twn_data:
-            tmp_TWN_pattern[cluster_center[3]] = {}
-            for trj, single_data in single_box.items():
-                if trj != twn_name.split("_")[1]:
-                    for single_water in single_data:
-                        if dist(tuple(cluster_center[4:7]), tuple(single_water[4:7])) <= 1.0:
-                            tmp_TWN_pattern[cluster_center[3]][single_water[2]] = single_water[3]
-        accepted_trj = {key: True for key in list(set([x for x in single_box.keys()]))}
-        accepted_trj_copy = list(accepted_trj.keys())
-        for tmp_trj in tmp_TWN_pattern.values():
-            for trajec in accepted_trj_copy:
-                if trajec not in list(tmp_trj.keys()):
-                    accepted_trj[trajec] = False
-        TWN_patterns[twn_name][twn_name.split("_")[1]] = "-".join(list(tmp_TWN_pattern.keys()))
-        for atk, atv in accepted_trj.items():
-            if atv:
-                TWN_patterns[twn_name][atk] = "-".join([v[atk] for k, v in tmp_TWN_pattern.items()])
-
-    sorted_TWN_patterns = dict(sorted(TWN_patterns.items(), key=lambda x: len(list(x[1].keys())), reverse=True))
-    logger.info(f'Total TWN is {len(sorted_TWN_patterns.keys())}.')
+    table = TWN_occupancy(twn_box, single_box, engine, table, radius)
+    occupancy = occupancy_matrix(twn_box, table, list(dict.fromkeys(single_box['files'])))
+    return pattern_writer(twn_box, occupancy, twn_out, unique_radius, min_frequency)
+
+
+# chunked twn water : frames are read and matched block by block, only the occupancy of each block is kept
+def TWN_chunk_writer(twn_box, trj, boundary, twn_out=None, engine='grid', block=100, workers=1, radius=1.0, unique_radius=1.0,
+                     min_frequency=2, prefetch=None):
+    logger.info(f'Start identifying TWN-Patterns in blocks of {block} frames...')
+    all_trj = list(dict.fromkeys(trajectory for trajectory_file, trajectory, model in trj))
+    column = {trj: idx for idx, trj in enumerate(all_trj)}
+    names = {}
+    cols = [[] for _ in twn_box['files']]
+    water = [[] for _ in twn_box['files']]
+    centers = None
+    for start in range(0, len(trj), block):
+        block_box = single_reader(trj[start:start + block], boundary, workers, prefetch=prefetch)
+        part = occupancy_matrix(twn_box, TWN_occupancy(twn_box, block_box, engine, radius=radius), block_box['files'])
+        # block columns and name ids to the whole-trajectory ones
+        block_cols = np.array([column[trj] for trj in part['frames']], dtype=np.int64)
+        name_ids = np.array([names.setdefault(w_name, len(names)) for w_name in part['names']], dtype=np.int32)
+        for t_idx in range(len(twn_box['files'])):
+            cols[t_idx] += [block_cols[np.flatnonzero(np.unpackbits(part['occupied'][t_idx], count=len(part['frames'])))]]
+            water[t_idx] += [name_ids[part['water'][t_idx]]]
+        centers = part['centers']
+        del block_box, part
+
+    occupancy = {'frames': all_trj, 'names': list(names.keys()), 'water': [],
+                 'occupied': np.zeros((len(twn_box['files']), (len(all_trj) + 7) // 8), dtype=np.uint8)}
+    occupancy['centers'] = centers if centers is not None else [[] for _ in twn_box['files']]
+    for t_idx in range(len(twn_box['files'])):
+        t_cols = np.concatenate([np.empty(0, dtype=np.int64)] + cols[t_idx])
+        order = np.argsort(t_cols, kind='stable')
+        occupied = np.zeros(len(all_trj), dtype=bool)
+        occupied[t_cols] = True
+        occupancy['occupied'][t_idx] = np.packbits(occupied)
+        k = len(occupancy['centers'][t_idx])
+        occupancy['water'] += [np.concatenate([np.empty((0, k), dtype=np.int32)] + water[t_idx])[order]]
+    return pattern_writer(twn_box, occupancy, twn_out, unique_radius, min_frequency)
+
+
+# wilson score interval of hits out of n sampled frames, as fractions : (estimate, low, high)
+def wilson_bounds(hits, n, z=1.96):
+    hits = np.asarray(hits, dtype=np.float64)
+    n = np.asarray(n, dtype=np.float64)
+    safe_n = np.maximum(n, 1)
+    p = hits / safe_n
+    center = (p + z ** 2 / (2 * safe_n)) / (1 + z ** 2 / safe_n)
+    margin = z / (1 + z ** 2 / safe_n) * np.sqrt(p * (1 - p) / safe_n + z ** 2 / (4 * safe_n ** 2))
+    return p, np.where(n > 0, np.clip(center - margin, 0, 1), 0.0), np.where(n > 0, np.clip(center + margin, 0, 1), 1.0)
+
+
+# water store of some files of a twn or frame store, in the given order
+def water_subset(box, idxs):
+    names = np.array(box['names'], dtype=str)
+    file_box = {}
+    for idx in idxs:
+        rows = slice(box['offset'][idx], box['offset'][idx + 1])
+        file_box[box['files'][idx]] = (names[box['name'][rows]], box['coord'][rows])
+    return water_store(file_box)
+
+
+# estimated frequencies of a sampled occupancy as a csv table, highest estimate first
+def estimate_writer(estimate_file, twn_box, sample_frames, hits, estimate, low, high, refined):
+    with open(estimate_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['twn', 'sample_frames', 'sample_hits', 'estimated_frequency', 'low', 'high', 'refined'])
+        for t_idx in np.argsort(-estimate, kind='stable').tolist():
+            writer.writerow([twn_box['files'][t_idx], int(sample_frames[t_idx]), int(hits[t_idx]), f'{estimate[t_idx]:.1f}',
+                             f'{low[t_idx]:.1f}', f'{high[t_idx]:.1f}', int(t_idx in refined)])
+
+
+# progressive twn water : every stride-th frame is matched first and the frequency of each twn is estimated with wilson
+# bounds (z), then the likely top twns are matched on the remaining frames. a twn left out occurs at most in its sampled
+# frames plus the remaining frames matching its rarest center water; it is matched too while that bound reaches the
+# reported patterns, so the top patterns are those of the exhaustive run
+def progressive_writer(twn_box, single_box, twn_out=None, engine='grid', stride=10, top=10, radius=1.0, unique_radius=1.0,
+                       min_frequency=2, z=1.96):
+    if top < 1:
+        raise ValueError('progressive mode needs top, the number of top patterns to report')
+    logger.info(f'Start identifying TWN-Patterns progressively from every {stride}th frame...')
+    all_trj = list(dict.fromkeys(single_box['files']))
+    sample_box = water_subset(single_box, range(0, len(single_box['files']), stride))
+    sample_table = TWN_occupancy(twn_box, sample_box, engine, radius=radius)
+    sample_frequency = occupancy_frequency(twn_box, occupancy_matrix(twn_box, sample_table, sample_box['files']))
+
+    # estimated frequency over every frame other than the twn's own
+    sampled = set(sample_box['files'])
+    owns = [twn_name.split("_")[1] for twn_name in twn_box['files']]
+    sample_frames = np.array([len(sampled) - (own in sampled) for own in owns], dtype=np.int64)
+    other_frames = np.array([len(all_trj) - (own in all_trj) for own in owns], dtype=np.int64)
+    p, p_low, p_high = wilson_bounds(sample_frequency - 1, sample_frames, z)
+    estimate, low, high = 1 + p * other_frames, 1 + p_low * other_frames, 1 + p_high * other_frames
+    for t_idx in np.argsort(-estimate, kind='stable')[:5].tolist():
+        logger.info(f'Estimated frequency : {twn_box["files"][t_idx]} {estimate[t_idx]:.1f} [{low[t_idx]:.1f}, {high[t_idx]:.1f}]')
+
+    # bound of every twn : sampled frequency plus the remaining frames matching its rarest center water
+    rest_box = water_subset(single_box, [idx for idx in range(len(single_box['files'])) if idx % stride])
+    rest_index = {trajectory: idx for idx, trajectory in enumerate(rest_box['files'])}
+    rarest_rows = []
+    for t_idx, twn_name in enumerate(twn_box['files']):
+        centers = sample_table['twns'][twn_name]['centers']
+        rows = {twn_box['names'][twn_box['name'][row]]: row for row in range(twn_box['offset'][t_idx], twn_box['offset'][t_idx + 1])}
+        rarest_rows += [rows[min(centers, key=lambda c_name: len(centers[c_name]))]]
+    near = search_engines[engine](rest_box['coord'], radius)(twn_box['coord'][rarest_rows])
+    bound = sample_frequency + np.array([len(center_matches(rest_box, rows, rest_index.get(own, -1)))
+                                         for rows, own in zip(near, owns)], dtype=np.int64)
+
+    # likely top twns first : upper estimate reaching the lower estimate of the top-th one, or min_frequency
+    cutoff = np.sort(low)[::-1][min(top, len(low)) - 1] if len(low) else min_frequency
+    candidates = set(np.flatnonzero((high >= cutoff) & (bound >= min_frequency)).tolist())
+    refined = {}
+    while True:
+        new = sorted(candidates - set(refined))
+        if new:
+            rest_table = TWN_occupancy(water_subset(twn_box, new), rest_box, engine, radius=radius)
+            for t_idx in new:
+                twn_name = twn_box['files'][t_idx]
+                centers = {c_name: dict(matches) for c_name, matches in sample_table['twns'][twn_name]['centers'].items()}
+                for c_name, matches in rest_table['twns'][twn_name]['centers'].items():
+                    centers.setdefault(c_name, {}).update(matches)
+                refined[t_idx] = centers
+        t_idxs = sorted(refined)
+        refined_box = water_subset(twn_box, t_idxs)
+        table = {'twns': {twn_box['files'][t_idx]: {'centers': refined[t_idx]} for t_idx in t_idxs}}
+        patterns = pattern_writer(refined_box, occupancy_matrix(refined_box, table, all_trj), None, unique_radius, min_frequency)
+        cutoff = max(min_frequency, patterns[top - 1]['frequency']) if len(patterns) >= top else min_frequency
+        left = [t_idx for t_idx in np.flatnonzero(bound >= cutoff).tolist() if t_idx not in refined]
+        logger.info(f'Progressive refinement : {len(refined)} of {len(twn_box["files"])} TWN files matched on every frame, '
+                    f'{len(left)} more can reach frequency {cutoff}')
+        if not left:
+            break
+        candidates.update(left)
+
+    patterns = patterns[:top]
+    if twn_out is not None:
+        estimate_writer(Path(twn_out).with_name('TWN_estimate.csv'), twn_box, sample_frames, sample_frequency - 1,
+                        estimate, low, high, refined)
+        sdf_writer(twn_out, patterns)
+        pattern_store_writer(Path(twn_out).with_suffix('.npz'), patterns, twn_out)
+    return patterns
+
+
+# unique frequent twn patterns : ranked by frequency, a twn whose waters all lie within unique_radius of an accepted
+# pattern is a duplicate, ranking stops at the first unique twn below min_frequency
+def pattern_writer(twn_box, occupancy, twn_out=None, unique_radius=1.0, min_frequency=2):
+    # coordinates of each twn, and of the first row per water name
+    twn_coords = {}
+    twn_waters = {}
+    for t_idx, twn_name in enumerate(twn_box['files']):
+        rows = slice(twn_box['offset'][t_idx], twn_box['offset'][t_idx + 1])
+        twn_coords[twn_name] = twn_box['coord'][rows]
+        twn_waters[twn_name] = {}
+        for c_name, c_coord in zip(twn_box['name'][rows], twn_box['coord'][rows]):
+            twn_waters[twn_name].setdefault(twn_box['names'][c_name], c_coord)
+
+    # rank by frequency, stable for equal frequencies
+    frequency = occupancy_frequency(twn_box, occupancy)
+    ranking = np.argsort(-frequency, kind='stable')
+    logger.info(f'Total TWN is {len(ranking)}.')
     logger.info(f'Start extracting unique region frequent TWN Patterns...')
-    sd_idx = 0
     first_twn = True
+    patterns = []
     pattern_box = {}
-    twn_each = []
-    for t_name, t_trjs in tqdm(sorted_TWN_patterns.items()):
+    # accepted pattern waters, indexed as they are accepted
+    add_accepted, near_accepted = grid_index(unique_radius)
+    accepted_owner = []
+    accepted_size = []
+    for t_idx in tqdm(ranking.tolist()):
+        t_name = twn_box['files'][t_idx]
         unique = False
         if first_twn:
             unique = True
         else:
-            tmp_box = pattern_box
-            unique_check = True
-            for twn_n, twn_c in tmp_box.items():
-                unique_pass = True
-                for twn_cn in twn_c:
-                    unique_water = True
-                    twn_v = [x for x in twn_box[twn_n] if x[3] == twn_cn]
-                    twn_coord = twn_v[0][4:7]
-                    for twn_d in twn_box[t_name]:
-                        if dist(twn_coord, tuple(twn_d[4:7])) <= 1.0:
-                            unique_water = False
-                            break
-                    if unique_water:
-                        unique_pass = False
-                if unique_pass:
-                    unique_check = False
-            if unique_check:
+            # an accepted pattern with every water near the candidate makes it a duplicate
+            near = np.unique(np.concatenate([np.empty(0, dtype=np.int64)] + near_accepted(twn_coords[t_name])))
+            covered = np.bincount(np.array(accepted_owner, dtype=np.int64)[near], minlength=len(accepted_size))
+            if not np.any(covered == np.array(accepted_size)):
                 unique = True
         if unique:
-            header_row = trans_format('sdf_header', 'TWN_Pattern_' + str(sd_idx + 1))
-            sd_idx += 1
-            twn_props = {'twn.center.name': t_name, 'twn.occupation.trjs': "  ".join(list(t_trjs.keys())),
-                         'twn.frequency': len(list(t_trjs.keys())),
-                         'twn.w.names': "  ".join(list(t_trjs.values()))}
-            count_row = trans_format('sdf_count', len(twn_box[t_name]), 0)
-            if twn_props['twn.frequency'] >= 2:
-                twn_each += [[header_row] + [count_row] +
-                             [trans_format('sdf_atom', x[4], x[5], x[6], "O", 0, 0) for x in list(twn_box[t_name])] +
-                             ['M  END'] + [trans_format('sdf_prop_s', 'twn.center.name', twn_props['twn.center.name'])] +
-                             [trans_format('sdf_prop_s', 'twn.occupation.trjs', twn_props['twn.occupation.trjs'])] +
-                             [trans_format('sdf_prop_d', 'twn.frequency', twn_props['twn.frequency'])] +
-                             [trans_format('sdf_prop_s', 'twn.w.names', twn_props['twn.w.names'])] + ['$$$$']]
-                pattern_box[t_name] = twn_props["twn.w.names"].split("  ")[0].split("-")
+            if frequency[t_idx] >= min_frequency:
+                trjs, w_names = occupancy_record(twn_box, occupancy, t_idx)
+                patterns += [{'name': 'TWN_Pattern_' + str(len(patterns) + 1), 'center_name': t_name,
+                              'coords': twn_coords[t_name], 'trjs': trjs,
+                              'frequency': int(frequency[t_idx]), 'w_names': w_names}]
+                pattern_box[t_name] = occupancy['centers'][t_idx]
+                add_accepted([twn_waters[t_name][twn_cn] for twn_cn in pattern_box[t_name]])
+                accepted_owner += [len(accepted_size)] * len(pattern_box[t_name])
+                accepted_size += [len(pattern_box[t_name])]
             else:
                 break
             first_twn = False
-    logger.info(f'Unique TWN Patterns = {len(sorted_TWN_patterns.keys())}(Total TWN Patterns) - {len(sorted_TWN_patterns.keys()) - len(pattern_box.keys())}(Duplicated TWN Patterns) = {len(pattern_box.keys())}')
-    twn_sdf = sum(twn_each, [])
-    # write twn
-    with open(twn_out, 'w') as f:
-        for line in twn_sdf:
+    logger.info(f'Unique TWN Patterns = {len(ranking)}(Total TWN Patterns) - {len(ranking) - len(pattern_box.keys())}(Duplicated TWN Patterns) = {len(pattern_box.keys())}')
+    # write twn, and the binary sidecar of the same records
+    if twn_out is not None:
+        sdf_writer(twn_out, patterns)
+        pattern_store_writer(Path(twn_out).with_suffix('.npz'), patterns, twn_out)
+
+    return patterns
+
+
+# sdf lines of pattern records, one record at a time
+def pattern_sdf(patterns):
+    for pattern in patterns:
+        yield trans_format('sdf_header', pattern['name'])
+        yield trans_format('sdf_count', len(pattern['coords']), 0)
+        for x in np.asarray(pattern['coords']).tolist():
+            yield trans_format('sdf_atom', x[0], x[1], x[2], "O", 0, 0)
+        yield 'M  END'
+        yield trans_format('sdf_prop_s', 'twn.center.name', pattern['center_name'])
+        yield trans_format('sdf_prop_s', 'twn.occupation.trjs', "  ".join(pattern['trjs']))
+        yield trans_format('sdf_prop_d', 'twn.frequency', pattern['frequency'])
+        yield trans_format('sdf_prop_s', 'twn.w.names', "  ".join(pattern['w_names']))
+        yield '$$$$'
+
+
+def sdf_writer(sdf_file, patterns):
+    with open(sdf_file, 'w') as f:
+        for line in pattern_sdf(patterns):
             f.write(f"{line}\n")
 
-    return twn_sdf
+
+# pattern records as flat arrays (TWN.npz next to TWN.sdf), stamped with the sdf file they belong to
+def pattern_store_writer(store_file, patterns, sdf_file):
+    tmp_file = f"{store_file}.{os.getpid()}.npz"
+    np.savez(tmp_file, sdf=np.array(file_stamp(sdf_file), dtype=np.int64),
+             name=np.array([pattern['name'] for pattern in patterns], dtype=str),
+             center_name=np.array([pattern['center_name'] for pattern in patterns], dtype=str),
+             frequency=np.array([pattern['frequency'] for pattern in patterns], dtype=np.int64),
+             offset=np.cumsum([0] + [len(pattern['coords']) for pattern in patterns], dtype=np.int64),
+             coord=np.concatenate([np.empty((0, 3))] + [np.asarray(pattern['coords'], dtype=np.float64).reshape(-1, 3)
+                                                        for pattern in patterns]),
+             trj_offset=np.cumsum([0] + [len(pattern['trjs']) for pattern in patterns], dtype=np.int64),
+             trjs=np.array([trj for pattern in patterns for trj in pattern['trjs']], dtype=str),
+             w_names=np.array([w_name for pattern in patterns for w_name in pattern['w_names']], dtype=str))
+    os.replace(tmp_file, store_file)
+
+
+# pattern records of a sidecar, None if missing or older than its sdf file
+def pattern_store_reader(store_file, sdf_file):
+    if not os.path.isfile(store_file) or not os.path.isfile(sdf_file):
+        return None
+    with np.load(store_file) as store:
+        if store['sdf'].tolist() != file_stamp(sdf_file):
+            return None
+        offset, trj_offset = store['offset'], store['trj_offset']
+        trjs, w_names = store['trjs'].tolist(), store['w_names'].tolist()
+        return [{'name': name, 'center_name': center_name, 'coords': store['coord'][offset[idx]:offset[idx + 1]],
+                 'trjs': trjs[trj_offset[idx]:trj_offset[idx + 1]], 'frequency': frequency,
+                 'w_names': w_names[trj_offset[idx]:trj_offset[idx + 1]]}
+                for idx, (name, center_name, frequency) in
+                enumerate(zip(store['name'].tolist(), store['center_name'].tolist(), store['frequency'].tolist()))]
+
+
+# twn waters of one protein
+def twn_inputs(twn_path, workers=1, prefetch=None):
+    logger.info(f'Loading TWN data...')
+    TWN_path = Path(twn_path)
+    TWN = pdb_files(TWN_path)
+    with stage('TWN_reader'):
+        TWN_box = TWN_reader(TWN, workers, prefetch)
+    logger.info(f'Set TWN water : {TWN_path} | {len(TWN)} files in folder')
+    return TWN_box
+
+
+# trajectory frames and boundary of one protein
+def frame_inputs(trajectory_path, boundary_file):
+    logger.info(f'Loading single water data...')
+    single_path = Path(trajectory_path)
+    single_water = trajectory_frames(single_path)
+    boundary = boundary_reader(boundary_file)
+    logger.info(f'Set single water : {single_path} | {len(single_water)} frames in folder')
+    logger.info(rf'Limited boundary: Use {boundary_file}')
+    return single_water, boundary
+
+
+# error message of pattern thresholds, None when they are usable
+def threshold_error(radius, unique_radius, min_frequency):
+    if radius <= 0 or unique_radius <= 0:
+        return f'match radius ({radius:g}) and uniqueness radius ({unique_radius:g}) must be positive'
+    if min_frequency < 1:
+        return f'min_frequency ({min_frequency}) must be 1 or more'
+    return None
+
+
+# pattern identification of one protein, returns pattern records (TWN.sdf is written when twn_out is given)
+def pattern_identification(trajectory_path, boundary_file, twn_path, twn_out=None, workers=1, cache=None, engine='grid',
+                           table_file=None, block=0, radius=1.0, unique_radius=1.0, min_frequency=2, stride=0, top=0,
+                           prefetch=None):
+    logger.info(f'Start Pattern identification...')
+    if block < 0 or stride < 0 or top < 0:
+        raise ValueError('block, stride and top must be 0 or positive')
+    if threshold_error(radius, unique_radius, min_frequency) is not None:
+        raise ValueError(threshold_error(radius, unique_radius, min_frequency))
+    if block and table_file is not None:
+        raise ValueError('chunked mode (block) does not keep an occupancy table, use it without table_file')
+    if stride and (block or table_file is not None):
+        raise ValueError('progressive mode (stride) cannot be used with block or table_file')
+    if stride and not top:
+        raise ValueError('progressive mode (stride) needs top, the number of top patterns to report')
+    TWN_box = twn_inputs(twn_path, workers, prefetch)
+    single_water, boundary = frame_inputs(trajectory_path, boundary_file)
+
+    # chunked mode reads and matches the frames block by block, the frame cache is not used
+    if block:
+        with stage('TWN_writer'):
+            patterns = TWN_chunk_writer(TWN_box, single_water, boundary, twn_out, engine, block, workers,
+                                        radius, unique_radius, min_frequency, prefetch)
+        if twn_out is not None:
+            logger.info(f'Saved pdb : {twn_out}')
+        logger.info('Pattern identification complete.')
+        return patterns
+    # progressive mode matches a sample of the frames first, then the top twns on every frame
+    if stride:
+        with stage('single_reader'):
+            single_box = single_reader(single_water, boundary, workers, cache, prefetch)
+        with stage('TWN_writer'):
+            patterns = progressive_writer(TWN_box, single_box, twn_out, engine, stride, top, radius, unique_radius, min_frequency)
+        if twn_out is not None:
+            logger.info(f'Saved pdb : {twn_out}')
+        logger.info('Pattern identification complete.')
+        return patterns
+    with stage('single_reader'):
+        single_box = single_reader(single_water, boundary, workers, cache, prefetch)
+
+    # TWN pattern identification
+    # incremental mode keeps the occupancy table between runs
+    table = occupancy_reader(table_file, boundary, radius) if table_file is not None else None
+    with stage('TWN_writer'):
+        patterns = TWN_writer(TWN_box, single_box, twn_out, engine, table, radius, unique_radius, min_frequency)
+    if table_file is not None:
+        occupancy_writer(table_file, table)
+        logger.info(f'Saved occupancy table : {table_file}')
+    if twn_out is not None:
+        logger.info(f'Saved pdb : {twn_out}')
+
+    logger.info('Pattern identification complete.')
+    return patterns
+
+
+# ring sizes of a twn set, read from the oxygens of its files
+def ring_types(twn_box):
+    return sorted(set(np.diff(twn_box['offset']).tolist()))
+
+
+# pattern identification of several twn sets (ring types) of one protein, the frames are read and filtered once;
+# returns pattern records per twn set, TWN.sdf of each set is written when twn_outs are given
+def ring_identification(trajectory_path, boundary_file, twn_paths, twn_outs=None, workers=1, cache=None, engine='grid',
+                        table_files=None, radius=1.0, unique_radius=1.0, min_frequency=2, prefetch=None):
+    logger.info(f'Start Pattern identification of {len(twn_paths)} TWN sets...')
+    if threshold_error(radius, unique_radius, min_frequency) is not None:
+        raise ValueError(threshold_error(radius, unique_radius, min_frequency))
+    twn_outs = twn_outs if twn_outs is not None else [None] * len(twn_paths)
+    table_files = table_files if table_files is not None else [None] * len(twn_paths)
+    single_water, boundary = frame_inputs(trajectory_path, boundary_file)
+    with stage('single_reader'):
+        single_box = single_reader(single_water, boundary, workers, cache, prefetch)
+
+    ring_patterns = []
+    for twn_path, twn_out, table_file in zip(twn_paths, twn_outs, table_files):
+        TWN = pdb_files(twn_path)
+        with stage(f'TWN_reader {Path(twn_path).name}'):
+            TWN_box = TWN_reader(TWN, workers, prefetch)
+        logger.info(f'Set TWN water : {twn_path} | {len(TWN)} files in folder | ring type {ring_types(TWN_box)}')
+        table = occupancy_reader(table_file, boundary, radius) if table_file is not None else None
+        with stage(f'TWN_writer {Path(twn_path).name}'):
+            ring_patterns += [TWN_writer(TWN_box, single_box, twn_out, engine, table, radius, unique_radius, min_frequency)]
+        if table_file is not None:
+            occupancy_writer(table_file, table)
+            logger.info(f'Saved occupancy table : {table_file}')
+        if twn_out is not None:
+            logger.info(f'Saved pdb : {twn_out}')
+    logger.info('Pattern identification complete.')
+    return ring_patterns
+
+
+# name of one sweep setting
+def sweep_name(radius, unique_radius, min_frequency):
+    return f'match{radius:g}_unique{unique_radius:g}_freq{min_frequency:d}'
+
+
+# pattern identification for every (match radius, uniqueness radius, frequency cutoff) of a sweep, neighbors are
+# searched once at the largest match radius; returns {setting: pattern records}, TWN.sdf of each setting goes
+# to sweep_path/<setting name> when sweep_path is given
+def pattern_sweep(trajectory_path, boundary_file, twn_path, settings, sweep_path=None, workers=1, cache=None, engine='grid',
+                  prefetch=None):
+    logger.info(f'Start Pattern identification sweep over {len(settings)} settings...')
+    for setting in settings:
+        if threshold_error(*setting) is not None:
+            raise ValueError(f'{sweep_name(*setting)}: {threshold_error(*setting)}')
+    TWN_box = twn_inputs(twn_path, workers, prefetch)
+    single_water, boundary = frame_inputs(trajectory_path, boundary_file)
+    with stage('single_reader'):
+        single_box = single_reader(single_water, boundary, workers, cache, prefetch)
+    with stage('match_neighbors'):
+        neighbors = match_neighbors(TWN_box, single_box, engine, max(radius for radius, _, _ in settings))
+    all_trj = list(dict.fromkeys(single_box['files']))
+
+    sweep = {}
+    with stage('TWN_writer'):
+        for radius in dict.fromkeys(radius for radius, _, _ in settings):
+            occupancy = occupancy_matrix(TWN_box, neighbor_occupancy(TWN_box, single_box, neighbors, radius), all_trj)
+            for setting in [setting for setting in settings if setting[0] == radius]:
+                twn_out = None
+                if sweep_path is not None:
+                    os.makedirs(Path(sweep_path) / sweep_name(*setting), exist_ok=True)
+                    twn_out = Path(sweep_path) / sweep_name(*setting) / 'TWN.sdf'
+                logger.info(f'Sweep setting : {sweep_name(*setting)}')
+                sweep[setting] = pattern_writer(TWN_box, occupancy, twn_out, setting[1], setting[2])
+    logger.info('Pattern identification sweep complete.')
+    return sweep
 
 
 if __name__ == "__main__":
@@ -273,33 +1206,56 @@ if __name__ == "__main__":
     parser.add_argument('-twn', '--twn_water', required=True, help='Set your twn directory')
     parser.add_argument('-o', '--output', required=True, help='Set your output directory')
     parser.add_argument('-l', '--log', required=True, help='Set your log directory')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Set your number of parsing processes')
+    parser.add_argument('-c', '--cache', default=None, help='Set your frame cache file (.npz)')
+    parser.add_argument('-e', '--engine', default='grid', choices=list(search_engines.keys()), help='Set your neighbor search engine')
+    parser.add_argument('-pf', '--profile', action='store_true', help='Write a per-stage profile report next to the log')
+    parser.add_argument('-cp', '--cprofile', action='store_true', help='Dump cProfile statistics next to the log')
+    parser.add_argument('-i', '--incremental', action='store_true', help='Keep the occupancy table in the output directory and match only new frames and TWN files')
+    parser.add_argument('-b', '--block', type=int, default=0, help='Set your number of frames read at once (0 reads the whole trajectory)')
+    parser.add_argument('-mr', '--match_radius', type=float, default=1.0, help='Set your radius (A) matching a TWN water to a frame water')
+    parser.add_argument('-ur', '--unique_radius', type=float, default=1.0, help='Set your radius (A) making a TWN a duplicate of an accepted pattern')
+    parser.add_argument('-mf', '--min_frequency', type=int, default=2, help='Set your lowest frequency of a TWN pattern')
+    parser.add_argument('-ps', '--progressive', type=int, default=0, help='Set your sampling stride : match every n-th frame first, then the top TWNs on every frame (0 matches every frame at once)')
+    parser.add_argument('-tp', '--top', type=int, default=0, help='Set your number of top patterns reported in progressive mode (needed with -ps)')
+    parser.add_argument('-pq', '--prefetch_depth', type=int, default=8, help='Set your number of files read ahead of the parser with -w 1 (0 reads each file when it is parsed)')
+    parser.add_argument('-rs', '--read_size', type=int, default=1024, help='Set your read size (KB) of prefetched files')
     args = parser.parse_args()
+    if args.block < 0:
+        parser.error('-b/--block must be 0 or a positive number of frames')
+    if args.prefetch_depth < 0:
+        parser.error('-pq/--prefetch_depth must be 0 or a positive number of files')
+    if args.read_size < 1:
+        parser.error('-rs/--read_size must be 1 KB or more')
+    if args.match_radius <= 0 or args.unique_radius <= 0:
+        parser.error('-mr/--match_radius and -ur/--unique_radius must be positive')
+    if args.min_frequency < 1:
+        parser.error('-mf/--min_frequency must be 1 or more')
+    if args.top and not args.progressive:
+        parser.error('-tp/--top is only used with -ps/--progressive')
+    if args.top < 0:
+        parser.error('-tp/--top must be 0 or a positive number of patterns')
+    if args.progressive and args.top < 1:
+        parser.error('-ps/--progressive needs -tp/--top, the number of top patterns to report')
+    if args.block and args.incremental:
+        parser.error('-b/--block and -i/--incremental cannot be used together')
+    if args.progressive == 1 or args.progressive < 0:
+        parser.error('-ps/--progressive needs a stride of 2 or more')
+    if args.progressive and (args.block or args.incremental):
+        parser.error('-ps/--progressive cannot be used with -b/--block or -i/--incremental')
 
     # set output
     output_path = Path(rf"{args.output}")
     log_path = Path(rf"{args.log}")
     set_log(log_path, "TWN-Region-Analysis.log")
+    profiler = cprofile_start(args.cprofile)
 
     logger.info(f"Analysis for {log_path.stem}")
-    logger.info(f'Start Pattern identification...')
-    # set twn
-    logger.info(f'Loading TWN data...')
-    TWN_path = Path(rf"{args.twn_water}")
-    TWN = [twn for twn in TWN_path.glob('./*.pdb')]
-    TWN_out = output_path / f"TWN.sdf"
-    TWN_box = TWN_reader(TWN)
-    logger.info(f'Set TWN water : {TWN_path} | {len(TWN)} files in folder')
-
-    # set single water
-    logger.info(f'Loading single water data...')
-    single_path = Path(rf"{args.trajectory}")
-    single_water = [single for single in single_path.glob('./*.pdb')]
-    single_box = single_reader(single_water, args.boundary)
-    logger.info(f'Set single water : {single_path} | {len(single_water)} files in folder')
-    logger.info(rf'Limited boundary: Use {args.boundary}')
-
-    # TWN pattern identification
-    TWN_writer(TWN_box, single_box, TWN_out)
-    logger.info(f'Saved pdb : {TWN_out}')
-
-    logger.info('Pattern identification complete.')
\ No newline at end of file
+    pattern_identification(args.trajectory, args.boundary, args.twn_water, output_path / "TWN.sdf",
+                           args.workers, args.cache, args.engine,
+                           output_path / "TWN_occupancy.json" if args.incremental else None, args.block,
+                           args.match_radius, args.unique_radius, args.min_frequency, args.progressive, args.top,
+                           {'depth': args.prefetch_depth, 'read_size': args.read_size * 1024})
+    cprofile_dump(profiler, log_path / 'TWN_Pattern.prof')
+    if args.profile:
+        logger.info(f'Saved profile : {profile_writer(log_path, "TWN_Pattern")}')
@@ -0,0 +1,112 @@
+import sys
+import csv
+import json
+import time
+import cProfile
+from pathlib import Path
+from contextlib import contextmanager
+
+
+# stage records of this process : name -> wall time, cpu time, peak rss and counters
+stages = {}
+current_stage = []
+
+
+# peak resident memory in MB : since the last peak_reset where the kernel can reset it (Linux VmHWM),
+# otherwise the peak of the whole process; None where not available
+def peak_rss():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 2 ** 10, 3)
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10, 3)
+
+
+# reset the peak of peak_rss to the current resident memory; returns the scope of the next peak : 'stage' after
+# a reset, 'process' where the peak cannot be reset
+def peak_reset():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return 'stage'
+    except OSError:
+        return 'process'
+
+
+def peak_max(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+# time one stage, counters raised inside belong to it
+# the memory peak is the stage's own : running stages keep the peak reached so far before it is reset for this one
+@contextmanager
+def stage(name):
+    peak = peak_rss()
+    for running in current_stage:
+        stages[running]['peak_rss_mb'] = peak_max(stages[running]['peak_rss_mb'], peak)
+    stages[name] = {'wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_mb': None, 'peak_rss_scope': peak_reset(), 'counters': {}}
+    current_stage.append(name)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield stages[name]
+    finally:
+        stages[name]['wall_s'] = round(time.perf_counter() - wall, 4)
+        stages[name]['cpu_s'] = round(time.process_time() - cpu, 4)
+        stages[name]['peak_rss_mb'] = peak_max(stages[name]['peak_rss_mb'], peak_rss())
+        current_stage.pop()
+        for running in current_stage:
+            stages[running]['peak_rss_mb'] = peak_max(stages[running]['peak_rss_mb'], stages[name]['peak_rss_mb'])
+
+
+# add to a counter of the running stage
+def count(name, n=1):
+    if current_stage:
+        counters = stages[current_stage[-1]]['counters']
+        counters[name] = counters.get(name, 0) + int(n)
+
+
+# cProfile of the whole run when asked
+def cprofile_start(enabled):
+    if not enabled:
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def cprofile_dump(profiler, prof_file):
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(prof_file)
+
+
+# merge the stages of one program into the protein report (json and csv) and reset them, unless reset is False
+def profile_writer(log_path, program, reset=True):
+    json_file = Path(log_path) / 'TWN-Region-Analysis.profile.json'
+    report = json.loads(json_file.read_text()) if json_file.is_file() else {}
+    report[program] = dict(stages)
+    json_file.write_text(json.dumps(report, indent=2))
+
+    rows = []
+    for prog, prog_stages in report.items():
+        for name, record in prog_stages.items():
+            rows += [{'program': prog, 'stage': name, 'wall_s': record['wall_s'], 'cpu_s': record['cpu_s'],
+                      'peak_rss_mb': record['peak_rss_mb'], 'peak_rss_scope': record.get('peak_rss_scope', 'process'),
+                      **record['counters']}]
+    fields = ['program', 'stage', 'wall_s', 'cpu_s', 'peak_rss_mb', 'peak_rss_scope']
+    fields += sorted(set(key for row in rows for key in row) - set(fields))
+    with open(json_file.with_suffix('.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    if reset:
+        stages.clear()
+    return json_file
@@ -2,8 +2,9 @@ import os
 import logging
 import argparse
 import numpy as np
-from math import dist
 from pathlib import Path
+from TWN_Pattern import grid_engine, pattern_store_reader
+from TWN_Profile import stage, count, cprofile_start, cprofile_dump, profile_writer
 
 
 # module info option
@@ -22,28 +23,58 @@ def set_log(path_output, log_message):
     )
 
 
+# sdf records in one pass : (name, coords, properties), hydrogen and unknown atoms are skipped
 def sdf_reader(sdf_file):
-    point_dicts = {}
-    line_dicts = {}
     with open(sdf_file, 'r') as f:
-        lines = f.readlines()
-        naming = True
-        points = []
-        line_for_1pattern = []
-        for line in lines:
-            line_for_1pattern += [line]
-            if naming:
-                name = line.strip()
-                naming = False
-            if len(line) == 40 and len(line.split()) == 6 and line.split()[3] != 'H' and line.split()[3] != '?':
-                points += [(float(line.split()[0]), float(line.split()[1]), float(line.split()[2]))]
-            if line.startswith('$$$$'):
-                point_dicts[name] = points
-                points = []
-                line_dicts[name] = line_for_1pattern
-                line_for_1pattern = []
-                naming = True
-    return point_dicts, line_dicts
+        record = None
+        for line in f:
+            line = line.rstrip('\r\n')
+            if record is None:
+                record = {'name': line.strip(), 'row': 0, 'atoms': 0, 'points': [], 'props': {}, 'tag': None}
+            elif line.startswith('$$$$'):
+                yield record['name'], record['points'], record['props']
+                record = None
+                continue
+            record['row'] += 1
+            if record['row'] == 4:
+                # counts line : atom count in the first 3 columns, whitespace separated as a fallback
+                fields = line.split()
+                record['atoms'] = int(line[:3]) if line[:3].strip().isdigit() else int(fields[0]) if fields else 0
+            elif 4 < record['row'] <= 4 + record['atoms']:
+                fields = line.split()
+                if len(fields) >= 4 and fields[3] not in ('H', '?'):
+                    record['points'] += [(float(fields[0]), float(fields[1]), float(fields[2]))]
+            elif line.startswith('>') and '<' in line:
+                record['tag'] = line[line.index('<') + 1:line.rindex('>')]
+                record['props'][record['tag']] = ''
+            elif record['tag'] is not None:
+                if line.strip():
+                    record['props'][record['tag']] = (record['props'][record['tag']] + ' ' + line.strip()).strip()
+                else:
+                    record['tag'] = None
+        if record is not None and record['row'] > 4:
+            yield record['name'], record['points'], record['props']
+
+
+# pattern records of a TWN.sdf file, from its binary sidecar (TWN.npz) when it is up to date
+def pattern_reader(sdf_file):
+    patterns = pattern_store_reader(Path(sdf_file).with_suffix('.npz'), sdf_file)
+    if patterns is not None:
+        logger.info(f"Pattern records : {Path(sdf_file).with_suffix('.npz')}")
+        return patterns
+    patterns = []
+    for name, points, props in sdf_reader(sdf_file):
+        patterns += [{'name': name, 'center_name': props.get('twn.center.name', ''),
+                      'coords': np.array(points, dtype=np.float64).reshape(-1, 3),
+                      'trjs': props.get('twn.occupation.trjs', '').split(), 'frequency': int(props.get('twn.frequency', 0)),
+                      'w_names': props.get('twn.w.names', '').split()}]
+    logger.info(f"Pattern records : {sdf_file}")
+    return patterns
+
+
+# coordinates as written in the sdf atom block (4 decimals)
+def sdf_coords(coords):
+    return np.array([[float("{:.4f}".format(x)) for x in xyz] for xyz in np.asarray(coords).tolist()], dtype=np.float64).reshape(-1, 3)
 
 
 # trans format
@@ -65,58 +96,77 @@ def trans_format(form, *vals):
     return trans[form].format(*vals)
 
 
-def region_extractor(inputpath, protein):
-    os.mkdir(inputpath + f'/TWN-Region/{protein}')
-    file = inputpath + f'/TWN-Pattern/{protein}/TWN.sdf'
-    point_dicts, line_dicts = sdf_reader(file)
-    ring_type = int(list(line_dicts.values())[0][3].split()[0])
-    pattern_counting = {}
-    for name, points in point_dicts.items():
-        mean_points = np.mean(points, axis=0)
-        pattern_counting[name] = []
-        for n, p in point_dicts.items():
-            if dist(mean_points, np.mean(p, axis=0)) <= 1:
-                pattern_counting[name] += [n]
-
-    sorted_pattern_counting = dict(sorted(pattern_counting.items(), key=lambda x: len(set(sum([line_dicts[x][ring_type + 9].strip().split() for x in x[1]], []))), reverse=True))
-    region_number = 1
-    registered_patterns = []
+# region records from pattern records (region files are written when region_path is given)
+def region_extractor(patterns, region_path=None, radius=1.0):
+    if radius <= 0:
+        raise ValueError(f'centroid radius ({radius:g}) must be positive')
+    if len(patterns) == 0:
+        return []
+    names = [pattern['name'] for pattern in patterns]
+    points = {pattern['name']: sdf_coords(pattern['coords']) for pattern in patterns}
+    # centroid of each pattern and the patterns with a centroid within radius (1 A by default)
+    centroids = np.array([np.mean(points[name], axis=0) for name in names]).reshape(-1, 3)
+    search = grid_engine(centroids, radius)
+    pattern_counting = {name: [names[idx] for idx in near] for name, near in zip(names, search(centroids))}
+    # occupied trajectories of each pattern and their union over each group
+    occupations = {pattern['name']: set(pattern['trjs']) for pattern in patterns}
+    union_frequency = {name: len(set().union(*[occupations[x] for x in group])) for name, group in pattern_counting.items()}
+
+    count('patterns', len(names))
+    sorted_pattern_counting = dict(sorted(pattern_counting.items(), key=lambda x: union_frequency[x[0]], reverse=True))
+    regions = []
+    registered_patterns = set()
     for g_name, g_patterns in sorted_pattern_counting.items():
         unique = True
         for g_pattern in g_patterns:
             if g_pattern in registered_patterns:
                 unique = False
         if unique:
-            region_name = f'TWN_Region_{region_number}'
-            frequency = len(set(sum([line_dicts[x][ring_type + 9].strip().split() for x in g_patterns], [])))
-            w= open(inputpath + f'/TWN-Region/{protein}/{region_name}.sdf', 'w')
-            header_row = trans_format('sdf_header', 'TWN_Region_' + str(region_number))
-
-            count_row = trans_format('sdf_count', ring_type * len(g_patterns), 0)
-            w.write(header_row + '\n' + count_row + '\n')
-            for g_pattern in g_patterns:
-                for g_line in line_dicts[g_pattern][4:4+ring_type]:
-                    w.write(g_line)
-            w.write(f'M  END\n\n> <region.frequency>\n{frequency}\n\n> <twn.pattern.names>\n{"  ".join(g_patterns)}\n')
-            w.close()
-            region_number += 1
-            registered_patterns += g_patterns
-    return
+            regions += [{'name': f'TWN_Region_{len(regions) + 1}', 'frequency': union_frequency[g_name],
+                         'patterns': g_patterns, 'coords': np.concatenate([points[x] for x in g_patterns])}]
+            registered_patterns.update(g_patterns)
+    count('regions', len(regions))
+    if region_path is not None:
+        for region in regions:
+            region_writer(region, Path(region_path) / f"{region['name']}.sdf")
+    return regions
+
+
+# write one region sdf file
+def region_writer(region, region_file):
+    with open(region_file, 'w') as w:
+        w.write(trans_format('sdf_header', region['name']) + '\n' + trans_format('sdf_count', len(region['coords']), 0) + '\n')
+        for x in region['coords'].tolist():
+            w.write(trans_format('sdf_atom', x[0], x[1], x[2], "O", 0, 0) + '\n')
+        w.write(f'M  END\n\n> <region.frequency>\n{region["frequency"]}\n\n> <twn.pattern.names>\n{"  ".join(region["patterns"])}\n')
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Identify TWN Regions by its union frequency.')
     parser.add_argument('-d', '--directory', required=True, help='Set your trajectory directory')
+    parser.add_argument('-p', '--protein', default=None, help='Set one protein to analyze (all proteins by default)')
+    parser.add_argument('-pf', '--profile', action='store_true', help='Write a per-stage profile report next to the log')
+    parser.add_argument('-cp', '--cprofile', action='store_true', help='Dump cProfile statistics next to the log')
+    parser.add_argument('-cr', '--centroid_radius', type=float, default=1.0, help='Set your radius (A) grouping pattern centroids into a region')
     args = parser.parse_args()
+    if args.centroid_radius <= 0:
+        parser.error('-cr/--centroid_radius must be positive')
 
     inputpath = args.directory.replace("\\", "/")
-    proteins = os.listdir(inputpath + "/TWN-Pattern")
-    os.mkdir(inputpath + "/TWN-Region")
+    proteins = os.listdir(inputpath + "/TWN-Pattern") if args.protein is None else [args.protein]
+    os.makedirs(inputpath + "/TWN-Region", exist_ok=True)
     for protein in proteins:
         log_path = Path(inputpath + '/logs/' + protein)
         set_log(log_path, "TWN-Region-Analysis.log")
         logger.info(f"Start Region identification...")
-        region_extractor(inputpath, protein)
+        profiler = cprofile_start(args.cprofile)
+        os.mkdir(inputpath + f'/TWN-Region/{protein}')
+        with stage('region_extractor'):
+            region_extractor(pattern_reader(inputpath + f'/TWN-Pattern/{protein}/TWN.sdf'), inputpath + f'/TWN-Region/{protein}',
+                             args.centroid_radius)
+        cprofile_dump(profiler, log_path / 'TWN_Region.prof')
         logger.info(f"Region identification complete.")
         logger.info(f"{len(os.listdir(inputpath + '/TWN-Region/' + protein))} Regions are extracted from {protein}.")
+        if args.profile:
+            logger.info(f'Saved profile : {profile_writer(log_path, "TWN_Region")}')
     logger.info(f"Process finished.")
\ No newline at end of file
@@ -0,0 +1,162 @@
+import os
+import sqlite3
+import logging
+import argparse
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+
+from TWN_Region import sdf_reader, pattern_reader
+
+
+# module info option
+logger = logging.getLogger(__name__)
+
+
+# results store : one run per (protein, setting), its patterns and regions with their waters, occupied trajectories
+# and member patterns; frequency indexes and r-tree boxes of the waters for spatial queries
+results_schema = """
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, protein TEXT NOT NULL, code TEXT NOT NULL, setting TEXT NOT NULL,
+                                 time TEXT NOT NULL, UNIQUE (protein, setting));
+CREATE TABLE IF NOT EXISTS patterns (id INTEGER PRIMARY KEY, run INTEGER NOT NULL, name TEXT NOT NULL, center_name TEXT NOT NULL,
+                                     frequency INTEGER NOT NULL, ring_type INTEGER NOT NULL, x REAL, y REAL, z REAL);
+CREATE TABLE IF NOT EXISTS pattern_waters (pattern INTEGER NOT NULL, idx INTEGER NOT NULL, x REAL, y REAL, z REAL);
+CREATE TABLE IF NOT EXISTS pattern_trjs (pattern INTEGER NOT NULL, trj TEXT NOT NULL, w_names TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS regions (id INTEGER PRIMARY KEY, run INTEGER NOT NULL, name TEXT NOT NULL, frequency INTEGER NOT NULL,
+                                    x REAL, y REAL, z REAL);
+CREATE TABLE IF NOT EXISTS region_patterns (region INTEGER NOT NULL, pattern INTEGER NOT NULL);
+CREATE VIRTUAL TABLE IF NOT EXISTS pattern_boxes USING rtree(id, min_x, max_x, min_y, max_y, min_z, max_z);
+CREATE VIRTUAL TABLE IF NOT EXISTS region_boxes USING rtree(id, min_x, max_x, min_y, max_y, min_z, max_z);
+CREATE INDEX IF NOT EXISTS runs_code ON runs (code);
+CREATE INDEX IF NOT EXISTS patterns_run ON patterns (run);
+CREATE INDEX IF NOT EXISTS patterns_frequency ON patterns (frequency);
+CREATE INDEX IF NOT EXISTS pattern_waters_pattern ON pattern_waters (pattern);
+CREATE INDEX IF NOT EXISTS pattern_trjs_pattern ON pattern_trjs (pattern);
+CREATE INDEX IF NOT EXISTS pattern_trjs_trj ON pattern_trjs (trj);
+CREATE INDEX IF NOT EXISTS regions_run ON regions (run);
+CREATE INDEX IF NOT EXISTS regions_frequency ON regions (frequency);
+CREATE INDEX IF NOT EXISTS region_patterns_region ON region_patterns (region);
+CREATE INDEX IF NOT EXISTS region_patterns_pattern ON region_patterns (pattern);
+"""
+
+
+# connection to the results store, the schema is made when missing; writers of parallel jobs wait for each other
+def results_open(db_file):
+    connection = sqlite3.connect(db_file, timeout=600)
+    connection.executescript(results_schema)
+    return connection
+
+
+# remove one run with its patterns and regions
+def run_delete(connection, run):
+    for table, column, owner in [('pattern_waters', 'pattern', 'patterns'), ('pattern_trjs', 'pattern', 'patterns'),
+                                 ('pattern_boxes', 'id', 'patterns'), ('region_patterns', 'region', 'regions'),
+                                 ('region_boxes', 'id', 'regions')]:
+        connection.execute(f"DELETE FROM {table} WHERE {column} IN (SELECT id FROM {owner} WHERE run = ?)", (run,))
+    connection.execute("DELETE FROM patterns WHERE run = ?", (run,))
+    connection.execute("DELETE FROM regions WHERE run = ?", (run,))
+    connection.execute("DELETE FROM runs WHERE id = ?", (run,))
+
+
+# bounding box of waters as r-tree columns
+def water_box(coords):
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    low, high = coords.min(axis=0).tolist(), coords.max(axis=0).tolist()
+    return low[0], high[0], low[1], high[1], low[2], high[2]
+
+
+# store the pattern and region records of one protein, replacing its earlier run of the same setting
+def results_writer(db_file, protein, patterns, regions, setting=''):
+    connection = results_open(db_file)
+    try:
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            for (run,) in connection.execute("SELECT id FROM runs WHERE protein = ? AND setting = ?", (protein, setting)).fetchall():
+                run_delete(connection, run)
+            run = connection.execute("INSERT INTO runs (protein, code, setting, time) VALUES (?, ?, ?, ?)",
+                                     (protein, protein.split("_")[1], setting,
+                                      datetime.now().isoformat(timespec='seconds'))).lastrowid
+            pattern_ids = {}
+            for pattern in patterns:
+                coords = np.asarray(pattern['coords'], dtype=np.float64).reshape(-1, 3)
+                pattern_id = connection.execute(
+                    "INSERT INTO patterns (run, name, center_name, frequency, ring_type, x, y, z) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (run, pattern['name'], pattern['center_name'], int(pattern['frequency']), len(coords),
+                     *np.mean(coords, axis=0).tolist())).lastrowid
+                pattern_ids[pattern['name']] = pattern_id
+                connection.executemany("INSERT INTO pattern_waters (pattern, idx, x, y, z) VALUES (?, ?, ?, ?, ?)",
+                                       [(pattern_id, idx, *xyz) for idx, xyz in enumerate(coords.tolist())])
+                connection.executemany("INSERT INTO pattern_trjs (pattern, trj, w_names) VALUES (?, ?, ?)",
+                                       [(pattern_id, trj, w_names) for trj, w_names in zip(pattern['trjs'], pattern['w_names'])])
+                connection.execute("INSERT INTO pattern_boxes VALUES (?, ?, ?, ?, ?, ?, ?)", (pattern_id, *water_box(coords)))
+            for region in regions:
+                coords = np.asarray(region['coords'], dtype=np.float64).reshape(-1, 3)
+                region_id = connection.execute("INSERT INTO regions (run, name, frequency, x, y, z) VALUES (?, ?, ?, ?, ?, ?)",
+                                               (run, region['name'], int(region['frequency']),
+                                                *np.mean(coords, axis=0).tolist())).lastrowid
+                connection.executemany("INSERT INTO region_patterns (region, pattern) VALUES (?, ?)",
+                                       [(region_id, pattern_ids[name]) for name in region['patterns']])
+                connection.execute("INSERT INTO region_boxes VALUES (?, ?, ?, ?, ?, ?, ?)", (region_id, *water_box(coords)))
+    finally:
+        connection.close()
+    logger.info(f"Saved results : {db_file} | {len(patterns)} patterns, {len(regions)} regions of {protein} {setting}".rstrip())
+    return run
+
+
+# regions with at least min_frequency, optionally of one PDB code, setting, and with a water box within radius of point;
+# one record per region with its protein, member pattern names and occupied trajectories
+def region_query(db_file, min_frequency=0, code=None, setting='', point=None, radius=1.0):
+    query = ("SELECT regions.id, runs.protein, regions.name, regions.frequency, regions.x, regions.y, regions.z "
+             "FROM regions JOIN runs ON runs.id = regions.run WHERE regions.frequency >= ? AND runs.setting = ?")
+    args = [min_frequency, setting]
+    if code is not None:
+        query += " AND runs.code = ?"
+        args += [code]
+    if point is not None:
+        query += (" AND regions.id IN (SELECT id FROM region_boxes WHERE min_x <= ? AND max_x >= ? AND min_y <= ? AND max_y >= ?"
+                  " AND min_z <= ? AND max_z >= ?)")
+        args += [bound for axis in point for bound in (axis + radius, axis - radius)]
+    connection = results_open(db_file)
+    try:
+        records = []
+        for region_id, protein, name, frequency, x, y, z in connection.execute(query + " ORDER BY regions.frequency DESC", args).fetchall():
+            members = connection.execute("SELECT patterns.name FROM region_patterns JOIN patterns ON patterns.id = region_patterns.pattern "
+                                         "WHERE region_patterns.region = ? ORDER BY region_patterns.rowid", (region_id,)).fetchall()
+            trjs = connection.execute("SELECT DISTINCT pattern_trjs.trj FROM region_patterns JOIN pattern_trjs "
+                                      "ON pattern_trjs.pattern = region_patterns.pattern WHERE region_patterns.region = ?",
+                                      (region_id,)).fetchall()
+            records += [{'protein': protein, 'name': name, 'frequency': frequency, 'centroid': (x, y, z),
+                         'patterns': [member for (member,) in members], 'trjs': sorted(trj for (trj,) in trjs)}]
+    finally:
+        connection.close()
+    return records
+
+
+# region records of a TWN-Region directory
+def region_reader(region_path):
+    regions = []
+    for region_file in sorted(Path(region_path).glob('TWN_Region_*.sdf'), key=lambda x: int(x.stem.split('_')[-1])):
+        for name, points, props in sdf_reader(region_file):
+            regions += [{'name': name, 'frequency': int(props.get('region.frequency', 0)),
+                         'patterns': props.get('twn.pattern.names', '').split(),
+                         'coords': np.array(points, dtype=np.float64).reshape(-1, 3)}]
+    return regions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fill the results store from finished TWN-Pattern and TWN-Region directories.')
+    parser.add_argument('-d', '--directory', required=True, help='Set your directory analyzed')
+    parser.add_argument('-db', '--database', default=None, help='Set your results store (TWN-Results.sqlite in the directory by default)')
+    parser.add_argument('-p', '--protein', default=None, help='Set one protein to store (all proteins by default)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+    inputpath = Path(args.directory)
+    database = args.database if args.database is not None else inputpath / 'TWN-Results.sqlite'
+    proteins = os.listdir(inputpath / 'TWN-Pattern') if args.protein is None else [args.protein]
+    for protein in proteins:
+        if not (inputpath / 'TWN-Pattern' / protein / 'TWN.sdf').is_file():
+            logger.info(f"Skip {protein} : no TWN.sdf")
+            continue
+        results_writer(database, protein, pattern_reader(inputpath / 'TWN-Pattern' / protein / 'TWN.sdf'),
+                       region_reader(inputpath / 'TWN-Region' / protein))
@@ -1,85 +1,143 @@
 import os
 import sys
-import pandas as pd
+import json
 import numpy as np
 import requests
 import argparse
 from tqdm import tqdm
+from pathlib import Path
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 from bs4 import BeautifulSoup as bs
+from TWN_Pattern import pdb_open, trajectory_frames, frame_groups, model_lines, archive_reader, archive_frame
+
+
+# KLIFS numbers of the center residues
+# sites = {'AP': [15, 46, 51, 75], 'FP': [10, 51, 72, 81], 'GA': [17, 45, 81], 'SE': [51]} # KinFragLib binding site
+klifs_residues = [17, 51]
+
+
+# structure id of a pdb code from KLIFS structure records : the first chain A structure
+def KlifsID(structures, pdb):
+    for structure in structures:
+        if str(structure.get('pdb', '')).lower() == pdb.lower() and structure.get('chain') == 'A':
+            return str(structure['structure_ID'])
+    return None
 
 
 def DownloadKlifsID(pdb):
     page = requests.get(f'https://klifs.net/api/structures_pdb_list?pdb-codes={pdb}')
-    soup = bs(page.text, "html.parser")
-    txt = soup.text
-    files = txt.split('{')[1:]
-    dataframe = pd.DataFrame()
-    for file in files:
-        lines = file.split(',')
-        tmp = {}
-        # print(file)
-        for line in lines:
-            # print(line)
-            if line.startswith('"structure_ID"'):
-                tmp['ID'] = line[15:]
-            elif line.startswith('"kinase"'):
-                tmp['kinase'] = line[9:]
-            elif line.startswith('"pdb"'):
-                tmp['pdb'] = line[6:]
-            elif line.startswith('"alt"'):
-                tmp['alt'] = line[6:]
-            elif line.startswith('"chain"'):
-                tmp['chain'] = line[8:]
-            elif line.endswith('}') or line.endswith('}]'):
-                dataframe = pd.concat([dataframe, pd.DataFrame([tmp])], ignore_index=True)
-            else:
-                continue
-    for idx, ID in enumerate(dataframe['ID']):
-        if dataframe['chain'][idx][1:-1] != 'A':
-            continue
-        else:
-            A_chains = dataframe[dataframe['chain'] == 'A']
-            if (len(A_chains[A_chains['kinase'] == dataframe['kinase'][idx]]) >= 2) and (
-                    dataframe['alt'][idx][1:-1] != 'A'):
-                continue
-            else:
-                return ID
-
-
-def LoadAbsoluteResidue(pdb):
-
-    # sites = {'AP': [15, 46, 51, 75], 'FP': [10, 51, 72, 81], 'GA': [17, 45, 81], 'SE': [51]} # KinFragLib binding site
-    residues = [17, 51]
-    ID = DownloadKlifsID(pdb)
-    page = requests.get(f'https://klifs.net/details.php?structure_id={ID}')
-    soup = bs(page.text, "html.parser")
-    lines = str(soup).split('\n')
-    real_residues = []
-    for line in lines:
+    return KlifsID(json.loads(bs(page.text, "html.parser").text), pdb)
+
+
+# absolute residue numbers of the KLIFS numbers on a structure details page
+def AbsoluteResidue(html, residues=klifs_residues):
+    real_residues = {}
+    for line in str(bs(html, "html.parser")).split('\n'):
         if line.startswith('</tr><tr><td class="residueSearch">'):
             for residue in residues:
                 real_res_id = line.find(f'<td class="residueSearch">{residue} ')
                 if real_res_id != -1:
                     start = line.find('<span class="xray">', real_res_id + 28) + 19
                     end = line.find('</span>', start)
-                    real_residues += [line[start: end]]
-        else:
-            continue
+                    real_residues[str(residue)] = line[start: end]
     return real_residues
 
 
+def DownloadAbsoluteResidue(ID):
+    return AbsoluteResidue(requests.get(f'https://klifs.net/details.php?structure_id={ID}').text)
+
+
+# local KLIFS lookup table : pdb code -> structure id -> KLIFS number -> absolute residue
+def klifs_cache_reader(cache_file):
+    cache = {'structures': {}, 'residues': {}}
+    if cache_file is not None and os.path.isfile(cache_file):
+        with open(cache_file, 'r') as f:
+            saved = json.load(f)
+        cache['structures'].update(saved.get('structures', {}))
+        cache['residues'].update(saved.get('residues', {}))
+    return cache
+
+
+def klifs_cache_writer(cache_file, cache):
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, cache_file)
+
+
+# fill the lookup table from exported files : structure records (.json), lookup tables (.json)
+# and structure details pages saved as <structure id>.html
+def klifs_import(cache, files):
+    for file in files:
+        file = Path(file)
+        with open(file, 'r') as f:
+            text = f.read()
+        if file.suffix.lower() in ('.html', '.htm'):
+            cache['residues'].setdefault(file.stem, {}).update(AbsoluteResidue(text))
+            continue
+        saved = json.loads(text)
+        if isinstance(saved, dict):
+            cache['structures'].update(saved.get('structures', {}))
+            for ID, residues in saved.get('residues', {}).items():
+                cache['residues'].setdefault(ID, {}).update(residues)
+            continue
+        for pdb in dict.fromkeys(str(structure.get('pdb', '')).lower() for structure in saved):
+            ID = KlifsID(saved, pdb)
+            if ID is not None:
+                cache['structures'][pdb] = ID
+    return cache
+
+
+def LoadAbsoluteResidue(pdb, cache_file=None, offline=False, residues=klifs_residues):
+    cache = klifs_cache_reader(cache_file)
+    ID = cache['structures'].get(pdb.lower())
+    if ID is None and not offline:
+        ID = DownloadKlifsID(pdb)
+        if ID is not None:
+            cache['structures'][pdb.lower()] = ID
+    if ID is None:
+        sys.exit(f'Value error: No KLIFS structure of {pdb} in {cache_file}.\n')
+    real_residues = cache['residues'].get(ID, {})
+    if any(str(residue) not in real_residues for residue in residues) and not offline:
+        real_residues = DownloadAbsoluteResidue(ID)
+        cache['residues'][ID] = real_residues
+    if any(str(residue) not in real_residues for residue in residues):
+        sys.exit(f'Value error: No KLIFS residues of structure {ID} ({pdb}) in {cache_file}.\n')
+    if cache_file is not None and not offline:
+        klifs_cache_writer(cache_file, cache)
+    return [real_residues[str(residue)] for residue in residues]
+
+
+# CA atoms of the residues, reading stops at the solvent (or the end of the model) once every residue is found
 def Residue_based_center(inputfile, residue_lst):
+    with pdb_open(inputfile) as f:
+        return Residue_lines_center(f, residue_lst, inputfile)
+
+
+# center of the CA atoms found, source names the frame in the error raised when there is none
+def ca_center(coords, residue_lst, source):
+    if len(coords) == 0:
+        raise ValueError(f"No CA atom of residue {', '.join(str(residue) for residue in residue_lst)} in {source}")
+    return tuple(np.mean(coords, axis=0))
+
+
+def Residue_lines_center(lines, residue_lst, source='frame'):
+    residue_lst = [str(residue) for residue in residue_lst]
     coords = []
-    with open(inputfile) as f:
-        lines = f.readlines()
-        for line in lines:
-            if line.startswith('ATOM'):
-                for residue in residue_lst:
-                    if line[22:26].strip() == residue and line[13:15] == 'CA':
-                        coord = (float(line[31:38].strip()), float(line[39:46].strip()), float(line[47:54].strip()))
-                        coords += [coord]
-    center = np.mean(coords, axis=0)
-    return tuple(center)
+    found = set()
+    for line in lines:
+        if line.startswith('ATOM'):
+            if line[17:20] in ('SOL', 'HOH', 'WAT') and len(found) == len(set(residue_lst)):
+                break
+            for residue in residue_lst:
+                if line[22:26].strip() == residue and line[13:15] == 'CA':
+                    coord = (float(line[31:38].strip()), float(line[39:46].strip()), float(line[47:54].strip()))
+                    coords += [coord]
+                    found.add(residue)
+        elif line.startswith('ENDMDL') and len(found) == len(set(residue_lst)):
+            break
+    return ca_center(coords, residue_lst, source)
 
 
 def Klifs_absolute_residue_center(residues, inputfile):
@@ -103,50 +161,158 @@ def mkbsfiles(pdb, center, size, inputfile, outputpath):
 
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Automatic calculation')
-    parser.add_argument('-path', '--pdbpath', required=True, help='Set your trajectory directory to make boundary file')
-    args = parser.parse_args()
+# boundary centers of the frames of one file : (file, [(frame id, model)])
+def frame_center(frame_group, c_method, center, residues):
+    trajectory_file, frames = frame_group
+    if c_method == '0':
+        return [center] * len(frames)
+    if trajectory_file.suffix == '.twa':
+        archive = archive_reader(trajectory_file)
+        numbers = np.array(archive['key_numbers'], dtype=str)
+        centers = []
+        for trj, model in frames:
+            _, _, ca_coord, ca_key = archive_frame(archive, model)
+            centers += [ca_center(ca_coord[np.isin(numbers[ca_key], [str(residue) for residue in residues])], residues,
+                                  f'{trajectory_file} frame {trj}')]
+        return centers
+    if frames[0][1] is None:
+        return [Residue_based_center(trajectory_file, residues)]
+    models = {model: trj for trj, model in frames}
+    centers = {model: Residue_lines_center(lines, residues, f'{trajectory_file} frame {models[model]}')
+               for model, lines in model_lines(trajectory_file, models)}
+    return [centers[model] for trj, model in frames]
 
-    c_method = input("Select your boundary center method:\n"
-                     "[0] Coordinate (x, y, z)\n"
-                     "[1] Residue number\n"
-                     "[2] Kinase, centre of KLIFS number 17 and 51\n")
 
-    inputpath = args.pdbpath.replace("\\", "/")
+# write Center.bd of one trajectory directory, frames are read in parallel
+# a_input holds one pdb file per frame ({i}.pdb, .pdb.gz, .pdb.xz), multi-model pdb files or a frame archive (.twa)
+def boundary_writer(inputpath, c_method, size, center=None, residues=None, workers=1):
+    inputpath = str(inputpath).replace("\\", "/").rstrip("/")
+    frames = trajectory_frames(inputpath + '/a_input')
+    groups = frame_groups(sorted(frames, key=lambda x: int(x[1])))
+    if workers <= 1:
+        centers = [frame_center(group, c_method, center, residues) for group in tqdm(groups, desc="Making boundary file...")]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunk = max(1, len(groups) // (workers * 8))
+            centers = list(tqdm(pool.map(frame_center, groups, repeat(c_method), repeat(center), repeat(residues), chunksize=chunk),
+                                total=len(groups), desc="Making boundary file..."))
+
+    txt_lines = [f'# Boundary file for TWN-Region-Analysis\n# PDB ID: {inputpath.split("/")[-1]}\n\nMETHOD  point\n\nRANGE  {size}\n\n']
+    for (trajectory_file, group), group_c in zip(groups, centers):
+        for (trj, model), frame_c in zip(group, group_c):
+            txt_lines += ["COORD  {:6d}  {:8.3f}  {:8.3f}  {:8.3f}\n".format(int(trj), frame_c[0], frame_c[1], frame_c[2])]
+
+    boundary_path = "/".join(inputpath.split("/")[:-2]) + '/boundary/' + inputpath.split("/")[-1]
+    os.makedirs(boundary_path, exist_ok=True)
+    with open(boundary_path + '/Center.bd', 'w') as w:
+        for txt_line in txt_lines:
+            w.write(txt_line)
+    return boundary_path + '/Center.bd'
 
+
+# problem of one protein setting (method, center or residue, size), None when it can be used
+def setting_error(setting):
+    c_method = str(setting.get('method'))
+    if c_method not in ('0', '1', '2'):
+        return f"method must be 0, 1 or 2, not {setting.get('method')}"
+    if setting.get('size') is None:
+        return 'size is missing'
+    try:
+        float(setting['size'])
+    except (TypeError, ValueError):
+        return f"size must be a number, not {setting['size']}"
+    if c_method == '0':
+        center = setting.get('center')
+        if center is None:
+            return 'center is missing for method 0'
+        try:
+            if len(tuple(float(x) for x in (center.split(',') if isinstance(center, str) else center))) != 3:
+                return f'center must be three numbers, not {center}'
+        except (TypeError, ValueError):
+            return f'center must be three numbers, not {center}'
+    if c_method == '1' and setting.get('residue') is None:
+        return 'residue is missing for method 1'
+    return None
+
+
+# settings of one protein : method, center or residue, size
+def boundary_setting(inputpath, setting, klifs_cache=None, offline=False):
+    c_method = str(setting.get('method'))
     if c_method == '0':  # Give coordinate of center
-        center = tuple(float(x) for x in input('Input your coordinate(x, y, z). ex) 1, 2, 3\n').split(', '))
+        center = setting['center']
+        center = tuple(float(x) for x in (center.split(',') if isinstance(center, str) else center))
+        return c_method, center, None
     elif c_method == '1':  # Input residue C alpha chain atom
-        residue_number = int(input('Type the residue number to define as a center: ex) 274\n'))
+        return c_method, None, [str(setting['residue'])]
     elif c_method == '2':
-        residues = LoadAbsoluteResidue(inputpath.split("/")[-1])
-    else:
-        sys.exit('Value error: Please write a right c_method.\n')
-
-    size = float(input("Type your boundary size: ex) 20.5\n"))
+        return c_method, None, LoadAbsoluteResidue(inputpath.split("/")[-1], klifs_cache, offline)
+    sys.exit('Value error: Please write a right c_method.\n')
 
-    txt_lines = [f'# Boundary file for TWN-Region-Analysis\n# PDB ID: {inputpath.split("/")[-1]}\n\nMETHOD  point\n\nRANGE  {size}\n\n']
 
-    for i in tqdm(range(0, len(os.listdir(inputpath + '/a_input')) - 1), desc="Making boundary file..."):
-        # define center
-        if c_method == '0':  # Give coordinate of center
-            pass
-        elif c_method == '1':  # Input residue C alpha chain atom
-            center = Residue_based_center(inputpath + f'/a_input/{str(i)}.pdb', [residue_number])
-        elif c_method == '2':
-            center = Klifs_absolute_residue_center(residues, inputpath + f'/a_input/{str(i)}.pdb')
-        else:
-            sys.exit('Value error: Your given number is not proper or your input file is not appropriate.\n'
-                     '             Please check your input file.\n')
-        txt_lines += ["COORD  {:6d}  {:8.3f}  {:8.3f}  {:8.3f}\n".format(i, center[0], center[1], center[2])]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Automatic calculation')
+    parser.add_argument('-path', '--pdbpath', nargs='+', default=[], help='Set your trajectory directories to make boundary files')
+    parser.add_argument('-m', '--method', default=None, choices=['0', '1', '2'], help='Set your boundary center method (asked when not given)')
+    parser.add_argument('-ct', '--center', default=None, help='Set your center coordinate for method 0, ex) "1, 2, 3"')
+    parser.add_argument('-r', '--residue', default=None, help='Set your center residue number for method 1')
+    parser.add_argument('-s', '--size', type=float, default=None, help='Set your boundary size')
+    parser.add_argument('-cf', '--config', default=None, help='Set your JSON config file of proteins, ex) [{"path": ..., "method": 1, "residue": 274, "size": 20.5}]')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Set your number of frame reading processes')
+    parser.add_argument('-kc', '--klifs_cache', default='klifs_cache.json', help='Set your KLIFS lookup table for method 2')
+    parser.add_argument('-ki', '--klifs_import', nargs='+', default=[], help='Set your exported KLIFS files (.json, .html) to add to the lookup table')
+    parser.add_argument('-off', '--offline', action='store_true', help='Use only the KLIFS lookup table, no network access')
+    args = parser.parse_args()
 
-    os.mkdir("/".join(inputpath.split("/")[:-2]) + '/boundary')
-    os.mkdir("/".join(inputpath.split("/")[:-2]) + '/boundary/' + inputpath.split("/")[-1])
+    if args.klifs_import:
+        klifs_cache_writer(args.klifs_cache, klifs_import(klifs_cache_reader(args.klifs_cache), args.klifs_import))
+        print(f"KLIFS lookup table updated : {args.klifs_cache}")
 
-    w = open("/".join(inputpath.split("/")[:-2]) + '/boundary/' + inputpath.split("/")[-1] + '/Center.bd', 'w')
-    for txt_line in txt_lines:
-        w.write(txt_line)
-    w.close()
+    jobs = []
+    if args.config is not None:
+        with open(args.config, 'r') as f:
+            config = json.load(f)
+        for idx, job in enumerate(config):
+            error = 'path is missing' if not isinstance(job, dict) or job.get('path') is None else setting_error(job)
+            if error is not None:
+                sys.exit(f'Value error: {args.config} entry {idx + 1}: {error}.\n')
+            jobs += [(job['path'], job)]
+    if args.pdbpath and args.method is not None:
+        error = setting_error({'method': args.method, 'center': args.center, 'residue': args.residue,
+                               'size': 0.0 if args.size is None else args.size})
+        if error is not None:
+            parser.error(error.replace('center', '-ct/--center').replace('residue', '-r/--residue'))
+    for pdbpath in args.pdbpath:
+        if args.method is None:
+            c_method = input("Select your boundary center method:\n"
+                             "[0] Coordinate (x, y, z)\n"
+                             "[1] Residue number\n"
+                             "[2] Kinase, centre of KLIFS number 17 and 51\n")
+            setting = {'method': c_method}
+            if c_method == '0':
+                setting['center'] = input('Input your coordinate(x, y, z). ex) 1, 2, 3\n')
+            elif c_method == '1':
+                setting['residue'] = int(input('Type the residue number to define as a center: ex) 274\n'))
+            elif c_method != '2':
+                sys.exit('Value error: Please write a right c_method.\n')
+        else:
+            setting = {'method': args.method, 'center': args.center, 'residue': args.residue}
+        if args.size is None:
+            setting['size'] = float(input("Type your boundary size: ex) 20.5\n"))
+        else:
+            setting['size'] = args.size
+        jobs += [(pdbpath, setting)]
+    if not jobs and not args.klifs_import:
+        parser.error('one of -path/--pdbpath, -cf/--config or -ki/--klifs_import is required')
 
-    print("Boundary file generated.")
\ No newline at end of file
+    # every setting is checked before any frame is read
+    for pdbpath, setting in jobs:
+        error = setting_error(setting)
+        if error is not None:
+            sys.exit(f'Value error: {pdbpath}: {error}.\n')
+    settings = []
+    for pdbpath, setting in jobs:
+        inputpath = pdbpath.replace("\\", "/").rstrip("/")
+        settings += [(inputpath, float(setting['size'])) + boundary_setting(inputpath, setting, args.klifs_cache, args.offline)]
+    for inputpath, size, c_method, center, residues in settings:
+        boundary_file = boundary_writer(inputpath, c_method, size, center, residues, args.workers)
+        print(f"Boundary file generated : {boundary_file}")